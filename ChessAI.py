@@ -0,0 +1,765 @@
+"""
+The AI: finds the best move of a GameState with an iterative deepening negamax search with alpha-beta pruning.
+It uses a transposition table, move ordering (hash move, MVV-LVA captures, killer moves and history) and a
+quiescence search on the captures at the leaves.
+EngineWorker runs the search in a background process, so the GUI is never blocked while the AI thinks.
+analyse gives the best few moves (multi-PV) of many positions at once.
+"""
+
+import argparse
+import collections
+import multiprocessing
+import os
+import queue
+import time
+
+import ChessBook
+import ChessEngine
+import ChessEval
+import ChessStats
+import ChessTablebase
+
+
+MATE_SCORE = 100000
+INFINITY = 1000000
+MAX_PLY = 64
+# the scores beyond it are mates, found by the search (up to MAX_PLY plies) or in a tablebase from a ply of the search
+MATE_BOUND = MATE_SCORE - MAX_PLY - ChessTablebase.MAX_PLIES
+DEFAULT_TIME_LIMIT = 1.0  # seconds, when get_ai_move is given no limit
+# opening book consulted before searching (see ChessBook.py), if the file exists
+BOOK_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "book.bin")
+
+QUIET_FLAGS = (0, ChessEngine.FLAG_CASTLE)  # move flags of the moves which are not captures or promotions
+
+# transposition table entry flags: the score is exact, or only a lower/upper bound (after a cutoff)
+EXACT = 0
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+
+SearchResult = collections.namedtuple("SearchResult", "move score pv depth nodes time")
+
+
+class TranspositionTable:
+    """
+    Fixed-size table of the positions already searched, indexed by the hash of the position.
+    Each slot holds (hash, depth, score, flag, move id, generation). When two positions fall in the same slot the
+    deeper search is kept, unless the entry comes from an older search.
+    """
+
+    def __init__(self, size=1 << 20):
+        self.size = size
+        self.entries = [None] * size
+        self.generation = 0
+
+    def new_search(self):
+        self.generation += 1
+
+    def probe(self, key):
+        entry = self.entries[key % self.size]
+        if entry is not None and entry[0] == key:
+            return entry
+        return None
+
+    def store(self, key, depth, score, flag, move_id):
+        index = key % self.size
+        entry = self.entries[index]
+        if entry is None or entry[0] == key or depth >= entry[1] or entry[5] != self.generation:
+            self.entries[index] = (key, depth, score, flag, move_id, self.generation)
+
+    def clear(self):
+        self.entries = [None] * self.size
+
+
+def tablebase_score(result, ply):
+    """
+    Search score of a tablebase result (WIN, DRAW or LOSS, plies to mate) found at a ply.
+    """
+    wdl, plies = result
+    if wdl == ChessTablebase.WIN:
+        return MATE_SCORE - ply - plies
+    if wdl == ChessTablebase.LOSS:
+        return -MATE_SCORE + ply + plies
+    return 0
+
+
+_tablebases = None
+
+
+def get_tablebases():
+    """
+    The Tablebases of ChessTablebase.TABLEBASE_DIR, opened the first time (None if no table was built).
+    """
+    global _tablebases
+    if _tablebases is None:
+        tablebases = ChessTablebase.Tablebases()
+        if tablebases.max_pieces <= 2:
+            return None
+        _tablebases = tablebases
+    return _tablebases
+
+
+def score_to_tt(score, ply):
+    """
+    Mate scores are stored relative to the position (mate in n from here), not to the root.
+    """
+    if score > MATE_BOUND:
+        return score + ply
+    if score < -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def score_from_tt(score, ply):
+    if score > MATE_BOUND:
+        return score - ply
+    if score < -MATE_BOUND:
+        return score + ply
+    return score
+
+
+def max_search_depth(depth=None, time_limit=None):
+    """
+    Deepest iteration of a search with these limits (depth 4 with no limit at all, MAX_PLY with only a time limit).
+    Raise a ValueError for a depth below 1 or a time limit which is not positive.
+    """
+    if depth is not None and depth < 1:
+        raise ValueError(f"the search depth must be at least 1, not {depth}")
+    if time_limit is not None and time_limit <= 0:
+        raise ValueError(f"the time limit must be positive, not {time_limit}")
+    if depth is None:
+        return 4 if time_limit is None else MAX_PLY
+    return min(depth, MAX_PLY)
+
+
+class Searcher:
+    """
+    The search. Keep the same Searcher between moves of a game so the transposition table and the history stay warm.
+    """
+
+    def __init__(self, tt=None, evaluate=None, tablebases=None):
+        self.tt = tt if tt is not None else TranspositionTable()
+        self.evaluate = evaluate if evaluate is not None else ChessEval.evaluate
+        self.tablebases = tablebases if tablebases is not None else get_tablebases()  # endgames known exactly
+        self.history = [0] * 4096  # indexed by the start and end squares of the move (moveID & 4095)
+        self.killers = [[None, None] for _ in range(MAX_PLY + 1)]
+        self.pv = [[] for _ in range(MAX_PLY + 2)]
+        self.nodes = 0
+        self.stopped = False
+        self.deadline = None
+        self.stop_requested = None  # function telling if the search must stop now (ex: cancelled from the UI)
+
+    def search(self, gs, depth=None, time_limit=None, on_iteration=None):
+        """
+        Search the position until the depth is reached or the time (in seconds) is over, and return a SearchResult
+        of the last finished iteration: best move, score (centipawns, for the player to move), principal variation,
+        depth, nodes and time. With no limit at all, search to depth 4.
+        on_iteration(SearchResult) is called after each finished depth, to show the progress.
+        """
+        max_depth = max_search_depth(depth, time_limit)
+        start = time.perf_counter()
+        self.new_search()
+        result = SearchResult(None, 0, [], 0, 0, 0.0)
+        for current_depth in range(1, max_depth + 1):
+            score = self.negamax(gs, current_depth, -INFINITY, INFINITY, 0)
+            if self.stopped:
+                break
+            pv = list(self.pv[0])
+            result = SearchResult(pv[0] if pv else None, score, pv, current_depth, self.nodes,
+                                  time.perf_counter() - start)
+            if on_iteration is not None:
+                on_iteration(result)
+            if not pv or abs(score) > MATE_BOUND:
+                break  # no move or a forced mate found: searching deeper won't change anything
+            if time_limit is not None:
+                # the depth 1 always finishes, so there is always a move to play.
+                self.deadline = start + time_limit
+                if time.perf_counter() - start > time_limit / 2:
+                    break  # the next iteration would most likely not finish
+        return result._replace(nodes=self.nodes, time=time.perf_counter() - start)
+
+    def search_multipv(self, gs, multipv=1, depth=None, time_limit=None, on_iteration=None):
+        """
+        The `multipv` best moves of the position with their scores and principal variations: a list of SearchResult,
+        the best first (fewer if there are fewer legal moves, none if there is no move). Each depth searches the best
+        move, then the best of the other moves, and so on. Same limits as search; on_iteration(list of SearchResult)
+        is called after each finished depth.
+        """
+        max_depth = max_search_depth(depth, time_limit)
+        start = time.perf_counter()
+        self.new_search()
+        entry = self.tt.probe(gs.zobrist_hash)
+        root_moves = self.order_moves(gs, gs.getValidMoves(), entry[4] if entry is not None else None, 0)
+        lines = []
+        for current_depth in range(1, max_depth + 1):
+            remaining = list(root_moves)
+            new_lines = []
+            while remaining and len(new_lines) < multipv:
+                score, pv = self.search_root(gs, remaining, current_depth)
+                if self.stopped:
+                    break
+                new_lines.append(SearchResult(pv[0], score, pv, current_depth, self.nodes,
+                                              time.perf_counter() - start))
+                remaining.remove(pv[0])
+            if self.stopped:
+                break
+            lines = new_lines
+            if not lines:
+                break  # no legal move
+            # the moves of the lines first at the next depth, in their order
+            line_moves = [line.move for line in lines]
+            root_moves = line_moves + [move for move in root_moves if move not in line_moves]
+            if on_iteration is not None:
+                on_iteration(lines)
+            if time_limit is not None:
+                self.deadline = start + time_limit
+                if time.perf_counter() - start > time_limit / 2:
+                    break
+        return [line._replace(nodes=self.nodes, time=time.perf_counter() - start) for line in lines]
+
+    def search_root(self, gs, root_moves, depth):
+        """
+        (score, principal variation) of the best of the root moves searched to the depth, as negamax does at the root
+        but only over these moves.
+        """
+        alpha = -INFINITY
+        best_pv = []
+        for move in root_moves:
+            gs.make_move(move)
+            score = -self.negamax(gs, depth - 1, -INFINITY, -alpha, 1)
+            gs.undo_move()
+            if self.stopped:
+                return 0, []
+            if score > alpha or not best_pv:
+                alpha = score
+                best_pv = [move] + self.pv[1]
+        return alpha, best_pv
+
+    def new_search(self):
+        """
+        Age the transposition table and the history, and reset the counters, before searching a new position.
+        """
+        self.tt.new_search()
+        self.killers = [[None, None] for _ in range(MAX_PLY + 1)]
+        self.history = [value // 8 for value in self.history]
+        self.nodes = 0
+        self.stopped = False
+        self.deadline = None
+
+    def search_move(self, gs, move, depth, alpha, beta, time_limit=None):
+        """
+        Score of one root move searched to the depth with the window (alpha, beta), and its principal variation.
+        The parallel search gives the root moves to the workers with this.
+        """
+        self.nodes = 0
+        self.stopped = False
+        self.deadline = None if time_limit is None else time.perf_counter() + time_limit
+        gs.make_move(move)
+        score = -self.negamax(gs, depth - 1, -beta, -alpha, 1)
+        gs.undo_move()
+        return score, [move] + self.pv[1]
+
+    def check_time(self):
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            self.stopped = True
+        elif self.stop_requested is not None and self.stop_requested():
+            self.stopped = True
+
+    def order_moves(self, gs, moves, tt_move_id, ply):
+        """
+        Sort the moves so the best ones are searched first: hash move, captures (most valuable victim first, then
+        least valuable attacker), promotions, killer moves, then the quiet moves by history.
+        """
+        mailbox = gs.mailbox
+        killers = self.killers[ply]
+        history = self.history
+        values = ChessEval.PIECE_VALUES
+        scores = {}
+        for move in moves:
+            move_id = move.moveID
+            end = move_id >> 6 & 63
+            flags = move_id >> 12
+            if move_id == tt_move_id:
+                score = 10000000
+            elif mailbox[end] != ChessEngine.EMPTY or flags == ChessEngine.FLAG_ENPASSANT:
+                victim = "P" if flags == ChessEngine.FLAG_ENPASSANT else mailbox[end][1]
+                score = 1000000 + values[victim] * 10 - values[mailbox[move_id & 63][1]]
+            elif flags & ChessEngine.FLAG_PROMOTION:
+                score = 900000 + values[ChessEngine.PROMOTION_PIECES[flags & 3]]
+            elif move == killers[0]:
+                score = 800000
+            elif move == killers[1]:
+                score = 700000
+            else:
+                score = history[move_id & 4095]
+            scores[move] = score
+        moves.sort(key=scores.__getitem__, reverse=True)
+        return moves
+
+    def negamax(self, gs, depth, alpha, beta, ply):
+        """
+        Score of the position for the player to move, searched to the given depth (alpha-beta in negamax form).
+        """
+        self.pv[ply] = []
+        self.nodes += 1
+        if self.nodes & 1023 == 0:
+            self.check_time()
+        if self.stopped:
+            return 0
+        if ply >= MAX_PLY:
+            return self.evaluate(gs)
+        if ply > 0 and (gs.halfmove_clock >= 100 or gs.is_repetition(2)):
+            return 0  # the position was already seen (the opponent can repeat it again): draw
+        if ply > 0 and self.tablebases is not None:
+            result = self.tablebases.probe(gs)
+            if result is not None:
+                return tablebase_score(result, ply)
+        in_check = gs.is_in_check()
+        if in_check:
+            depth += 1  # don't stop the search in the middle of a check
+        if depth <= 0:
+            return self.quiescence(gs, alpha, beta, ply)
+
+        key = gs.zobrist_hash
+        entry = self.tt.probe(key)
+        tt_move_id = None
+        if entry is not None:
+            tt_move_id = entry[4]
+            if ply > 0 and entry[1] >= depth:
+                score = score_from_tt(entry[2], ply)
+                if entry[3] == EXACT:
+                    return score
+                if entry[3] == LOWER_BOUND and score >= beta:
+                    return score
+                if entry[3] == UPPER_BOUND and score <= alpha:
+                    return score
+
+        us = gs.color
+        them = ChessEngine.OPPONENT[us]
+        original_alpha = alpha
+        best_score = -INFINITY
+        best_move = None
+        for move in self.order_moves(gs, gs.get_possibles_moves(), tt_move_id, ply):
+            is_quiet = gs.mailbox[move.moveID >> 6 & 63] == ChessEngine.EMPTY and move.moveID >> 12 in QUIET_FLAGS
+            gs.make_move(move)
+            if gs.is_square_attacked(gs.king_sq[us], them):
+                gs.undo_move()
+                continue
+            score = -self.negamax(gs, depth - 1, -beta, -alpha, ply + 1)
+            gs.undo_move()
+            if self.stopped:
+                return 0
+            if score > best_score:
+                best_score = score
+                best_move = move
+                if score > alpha:
+                    alpha = score
+                    self.pv[ply] = [move] + self.pv[ply + 1]
+                    if alpha >= beta:
+                        if is_quiet:
+                            killers = self.killers[ply]
+                            if move != killers[0]:
+                                killers[1] = killers[0]
+                                killers[0] = move
+                            self.history[move.moveID & 4095] += depth * depth
+                        break
+
+        if best_move is None:  # no legal move: checkmate or stalemate
+            return -MATE_SCORE + ply if in_check else 0
+        if best_score <= original_alpha:
+            flag = UPPER_BOUND
+        elif best_score >= beta:
+            flag = LOWER_BOUND
+        else:
+            flag = EXACT
+        self.tt.store(key, depth, score_to_tt(best_score, ply), flag, best_move.moveID)
+        return best_score
+
+    def quiescence(self, gs, alpha, beta, ply):
+        """
+        Search only the captures (and promotions) until the position is quiet, so the evaluation is not done in the
+        middle of an exchange.
+        """
+        self.pv[ply] = []
+        self.nodes += 1
+        if self.nodes & 1023 == 0:
+            self.check_time()
+        if self.stopped:
+            return 0
+        stand_pat = self.evaluate(gs)
+        if stand_pat >= beta or ply >= MAX_PLY:
+            return stand_pat
+        if stand_pat > alpha:
+            alpha = stand_pat
+
+        mailbox = gs.mailbox
+        empty = ChessEngine.EMPTY
+        captures = [move for move in gs.get_possibles_moves()
+                    if mailbox[move.moveID >> 6 & 63] != empty or move.moveID >> 12 not in QUIET_FLAGS]
+        us = gs.color
+        them = ChessEngine.OPPONENT[us]
+        for move in self.order_moves(gs, captures, None, ply):
+            gs.make_move(move)
+            if gs.is_square_attacked(gs.king_sq[us], them):
+                gs.undo_move()
+                continue
+            score = -self.quiescence(gs, -beta, -alpha, ply + 1)
+            gs.undo_move()
+            if self.stopped:
+                return 0
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+                self.pv[ply] = [move] + self.pv[ply + 1]
+        return alpha
+
+
+_searcher = None
+_book = None
+
+
+def get_book():
+    """
+    The OpeningBook of BOOK_FILE, opened the first time it is asked for (None if there is no book).
+    """
+    global _book
+    if _book is None and os.path.exists(BOOK_FILE):
+        _book = ChessBook.OpeningBook(BOOK_FILE)
+    return _book
+
+
+def book_move(gs):
+    """
+    A move of the opening book for the position as a SearchResult (depth 0, no node searched), or None.
+    """
+    book = get_book()
+    move = book.choose_move(gs) if book is not None else None
+    if move is None:
+        return None
+    return SearchResult(move, 0, [move], 0, 0, 0.0)
+
+
+def get_ai_move(gs, depth=None, time_limit=None, use_book=True):
+    """
+    Best move for the player to move, as a SearchResult (move, score, pv, depth, nodes, time).
+    The opening book is looked up first. The transposition table is kept from one call to the next.
+    """
+    global _searcher
+    if use_book:
+        result = book_move(gs)
+        if result is not None:
+            return result
+    if depth is None and time_limit is None:
+        time_limit = DEFAULT_TIME_LIMIT
+    if _searcher is None:
+        _searcher = Searcher()
+    return _searcher.search(gs, depth=depth, time_limit=time_limit)
+
+
+# Background search: the engine runs in its own process so the game loop keeps handling the events and drawing while
+# it thinks. The requests go through a queue and the results come back through another one.
+# done: result is the final one. stats: with the final result, the ChessStats counters of the request if they are on.
+EngineUpdate = collections.namedtuple("EngineUpdate", "request_id result done stats", defaults=(None,))
+
+
+def _engine_process(requests, updates, cancelled, count):
+    """
+    Loop of the engine process: search each (request id, GameState, depth, time limit) request and send an
+    EngineUpdate after each depth and at the end, until the request None. A request stops as soon as the cancelled
+    value reaches its id. count: count the ChessStats counters and send them with each final result.
+    """
+    if count:
+        ChessStats.start_worker()
+    searcher = Searcher()
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, gs, depth, time_limit = request
+        if cancelled.value >= request_id:
+            continue
+        result = book_move(gs)
+        if result is not None:
+            updates.put(EngineUpdate(request_id, result, True, ChessStats.take() if count else None))
+            continue
+        searcher.stop_requested = lambda: cancelled.value >= request_id
+        result = searcher.search(gs, depth=depth, time_limit=time_limit,
+                                 on_iteration=lambda result: updates.put(EngineUpdate(request_id, result, False)))
+        updates.put(EngineUpdate(request_id, result, True, ChessStats.take() if count else None))
+
+
+class EngineWorker:
+    """
+    The search in a background process, with an asynchronous API: request() starts a search and returns at once,
+    poll() gives the EngineUpdates received since the last call (progress after each depth, then the final result)
+    and cancel() stops the search (its updates are not given anymore).
+    When ChessStats counts, the engine process counts too and its counters are added to the ones of this process as
+    its results come.
+    """
+
+    def __init__(self):
+        self.requests = multiprocessing.Queue()
+        self.updates = multiprocessing.Queue()
+        self.cancelled = multiprocessing.Value("i", 0)  # the requests with an id up to this one are cancelled
+        self.request_id = 0
+        self.process = multiprocessing.Process(target=_engine_process,
+                                               args=(self.requests, self.updates, self.cancelled,
+                                                     ChessStats.is_enabled()), daemon=True)
+        self.process.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def request(self, gs, depth=None, time_limit=None):
+        """
+        Start the search of the position (a copy of it is sent, so the game can go on). With no limit, search for
+        DEFAULT_TIME_LIMIT seconds. Return the id of the request, given back in its EngineUpdates.
+        """
+        if depth is None and time_limit is None:
+            time_limit = DEFAULT_TIME_LIMIT
+        max_search_depth(depth, time_limit)  # a bad limit raises here, not in the engine process
+        self.request_id += 1
+        self.requests.put((self.request_id, gs.copy(), depth, time_limit))
+        return self.request_id
+
+    def cancel(self):
+        """
+        Stop the search in progress and forget all the requests made until now.
+        """
+        self.cancelled.value = self.request_id
+
+    def poll(self):
+        """
+        The EngineUpdates of the requests not cancelled received since the last call, without waiting.
+        """
+        updates = []
+        while True:
+            try:
+                update = self.updates.get_nowait()
+            except queue.Empty:
+                break
+            if update.stats is not None:
+                ChessStats.merge(update.stats)
+            if update.request_id > self.cancelled.value:
+                updates.append(update)
+        return updates
+
+    def wait(self, timeout=None):
+        """
+        The next EngineUpdate of a request not cancelled, waiting for it up to timeout seconds (None if none came).
+        """
+        while True:
+            try:
+                update = self.updates.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            if update.stats is not None:
+                ChessStats.merge(update.stats)
+            if update.request_id > self.cancelled.value:
+                return update
+
+    def close(self):
+        self.cancel()
+        self.requests.put(None)
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+# Parallel search: the root moves are shared between processes (the GIL lets only one thread run python code at a
+# time). Each worker process keeps its own Searcher, so its transposition table stays warm from one task to the next.
+_worker_searcher = None
+_worker_search_id = None
+
+
+def _init_worker(tt_size):
+    global _worker_searcher
+    _worker_searcher = Searcher(TranspositionTable(tt_size))
+
+
+def _search_root_move(task):
+    """
+    Worker task: (search id, GameState, move id, depth, alpha, beta, deadline) -> (score, pv, nodes, stopped).
+    The deadline is a time.time() value, since the tasks can wait in the queue before starting.
+    """
+    global _worker_search_id
+    search_id, gs, move_id, depth, alpha, beta, deadline = task
+    time_limit = None if deadline is None else deadline - time.time()
+    if time_limit is not None and time_limit <= 0:
+        return 0, [], 0, True
+    if search_id != _worker_search_id:
+        _worker_search_id = search_id
+        _worker_searcher.new_search()
+    move = next(move for move in gs.getValidMoves() if move.moveID == move_id)
+    score, pv = _worker_searcher.search_move(gs, move, depth, alpha, beta, time_limit)
+    return score, pv, _worker_searcher.nodes, _worker_searcher.stopped
+
+
+class ParallelSearcher:
+    """
+    Search with a pool of worker processes, splitting the root moves between them. At each depth the best move of
+    the previous depth is searched first with the full window, then all the other moves are searched at the same time
+    against its score: they only have to prove they are better, which is much cheaper when they are not.
+    Close it (or use it in a with block) to stop the worker processes.
+    """
+
+    def __init__(self, workers=None, tt_size=1 << 20):
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ChessStats.pool(self.workers, initializer=_init_worker, initargs=(tt_size,))
+        self.search_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def search(self, gs, depth=None, time_limit=None):
+        """
+        Same as Searcher.search, with the work shared between the worker processes.
+        """
+        max_depth = max_search_depth(depth, time_limit)
+        start = time.perf_counter()
+        self.search_count += 1
+        search_id = (os.getpid(), id(self), self.search_count)
+        root_moves = gs.getValidMoves()
+        if not root_moves:
+            return SearchResult(None, -MATE_SCORE if gs.is_in_check() else 0, [], 0, 0, 0.0)
+        result = SearchResult(None, 0, [], 0, 0, 0.0)
+        nodes = 0
+        for current_depth in range(1, max_depth + 1):
+            deadline = None  # the depth 1 always finishes, so there is always a move to play.
+            if time_limit is not None and current_depth > 1:
+                deadline = time.time() + start + time_limit - time.perf_counter()
+            if result.move is not None:  # best move of the previous depth first
+                root_moves.sort(key=lambda move: move != result.move)
+            score, pv, task_nodes, stopped = next(ChessStats.imap(
+                self.pool, _search_root_move, [(search_id, gs, root_moves[0].moveID, current_depth, -INFINITY,
+                                                INFINITY, deadline)]))
+            nodes += task_nodes
+            if stopped:
+                break
+            best_score, best_pv = score, pv
+            tasks = [(search_id, gs, move.moveID, current_depth, best_score, INFINITY, deadline)
+                     for move in root_moves[1:]]
+            results = ChessStats.imap(self.pool, _search_root_move, tasks, ordered=False)
+            for score, pv, task_nodes, task_stopped in results:
+                nodes += task_nodes
+                stopped = stopped or task_stopped
+                if score > best_score:
+                    best_score, best_pv = score, pv
+            if stopped:
+                break
+            result = SearchResult(best_pv[0], best_score, best_pv, current_depth, nodes, time.perf_counter() - start)
+            if abs(best_score) > MATE_BOUND:
+                break
+            if time_limit is not None and time.perf_counter() - start > time_limit / 2:
+                break
+        return result._replace(nodes=nodes, time=time.perf_counter() - start)
+
+
+def _game_state(position):
+    """
+    GameState of a position given as a GameState or as a FEN (set up through the shared ChessEngine.POSITION_CACHE:
+    the positions of a game review come back again and again).
+    """
+    return ChessEngine.get_position(position)[0] if isinstance(position, str) else position
+
+
+def _analyse_position(task):
+    """
+    Worker task: (GameState or FEN, multipv, depth, time limit) -> the list of SearchResult of search_multipv.
+    """
+    position, multipv, depth, time_limit = task
+    return _worker_searcher.search_multipv(_game_state(position), multipv, depth, time_limit)
+
+
+def analyse(positions, depth=None, time_limit=None, multipv=1, workers=1, tt_size=1 << 20, searcher=None):
+    """
+    Analyse many positions (GameStates or FENs): for each one, in the same order, the list of the `multipv` best
+    moves given by Searcher.search_multipv (the limits are per position).
+    The positions are searched one after the other by the same Searcher, so its transposition table and history stay
+    warm from one to the next (positions of the same game share a lot). With several workers (0: all the cores),
+    each worker process keeps its own Searcher and gets runs of consecutive positions.
+    searcher: the Searcher to use with 1 worker, to keep it warm from one call to the next.
+    """
+    max_search_depth(depth, time_limit)
+    tasks = [(position, multipv, depth, time_limit) for position in positions]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(tasks) < 2:
+        searcher = searcher or Searcher(TranspositionTable(tt_size))
+        return [searcher.search_multipv(_game_state(position), multipv, depth, time_limit)
+                for position, multipv, depth, time_limit in tasks]
+    with ChessStats.pool(workers, initializer=_init_worker, initargs=(tt_size,)) as pool:
+        return list(ChessStats.imap(pool, _analyse_position, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+
+
+def measure_speedup(gs, depth, workers=None):
+    """
+    Search the position to the depth with 1 worker and with `workers` workers, and print the speedup.
+    Return (time with 1 worker, time with the workers).
+    """
+    workers = workers or os.cpu_count() or 1
+    times = []
+    for worker_count in (1, workers):
+        with ParallelSearcher(worker_count) as searcher:
+            result = searcher.search(gs, depth=depth)
+        times.append(result.time)
+        print(f"{worker_count:>3} worker(s): depth {result.depth}  {result.move.get_chess_notation()}  "
+              f"score {result.score}  {result.nodes} nodes  {result.time:.2f}s  "
+              f"{result.nodes / max(result.time, 1e-9):.0f} nodes/s")
+    print(f"speedup with {workers} workers: {times[0] / max(times[1], 1e-9):.2f}x")
+    return times[0], times[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search the best move of a position.")
+    parser.add_argument("--fen", help="position to search (default: the starting position)")
+    parser.add_argument("--depth", type=int)
+    parser.add_argument("--time", type=float, help="time limit in seconds")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes (0: all the cores)")
+    parser.add_argument("--speedup", action="store_true", help="compare the time with 1 worker and with --workers")
+    parser.add_argument("--multipv", type=int, default=1, help="number of best moves to show")
+    parser.add_argument("--positions", metavar="FILE", help="analyse the positions of a file, one FEN per line")
+    ChessStats.add_arguments(parser)
+    args = parser.parse_args()
+
+    gs = ChessEngine.GameState.from_fen(args.fen) if args.fen else ChessEngine.GameState()
+    with ChessStats.session(args):
+        if args.speedup:
+            measure_speedup(gs, args.depth or 4, args.workers or None)
+            return
+        if args.positions or args.multipv > 1:
+            if args.positions:
+                with open(args.positions) as positions_file:
+                    positions = [line.strip() for line in positions_file if line.strip()]
+            else:
+                positions = [gs]
+            start = time.perf_counter()
+            analyses = analyse(positions, args.depth, args.time, args.multipv, args.workers)
+            for position, lines in zip(positions, analyses):
+                print(position if isinstance(position, str) else position.to_fen())
+                for number, line in enumerate(lines, 1):
+                    print(f"  {number}. {line.move.get_chess_notation()}  score {line.score}  depth {line.depth}  "
+                          f"pv {' '.join(move.get_chess_notation() for move in line.pv)}")
+            print(f"{len(positions)} positions in {time.perf_counter() - start:.2f}s")
+            return
+        if args.workers == 1:
+            result = Searcher().search(gs, depth=args.depth, time_limit=args.time)
+        else:
+            with ParallelSearcher(args.workers or None) as searcher:
+                result = searcher.search(gs, depth=args.depth, time_limit=args.time)
+    print(f"best move {result.move.get_chess_notation() if result.move else None}  score {result.score}  "
+          f"depth {result.depth}  pv {' '.join(move.get_chess_notation() for move in result.pv)}  "
+          f"{result.nodes} nodes  {result.time:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+Game archive: games in a compact binary format (2 bytes per move: the Move.moveID), appended to one file with an
+index of where each game starts, so game N is read through mmap without reading the games before it.
+
+    archive file:   MAGIC, then the records one after the other
+    record:         RECORD_HEADER (number of moves, length of the tags, result), the tags ("name\\0value\\0..." in
+                    UTF-8, the starting FEN is one of them when the game doesn't start from the beginning), the move IDs
+    index file:     (archive path + ".idx") the offset of each record, 8 bytes big-endian
+
+The files are only appended to. If a write was interrupted, the next ArchiveWriter drops the unfinished record and
+indexes the finished ones which were not.
+
+usage:
+    python ChessArchive.py import games.pgn games.cga      # append the games of a PGN file
+    python ChessArchive.py show games.cga 1234             # print game 1234 (from 0) as PGN
+    python ChessArchive.py info games.cga
+"""
+
+import argparse
+import collections
+import mmap
+import os
+import struct
+import time
+
+import ChessEngine
+import ChessPGN
+import ChessStats
+from ChessEngine import Move
+
+
+MAGIC = b"CGA1"
+RECORD_HEADER = struct.Struct(">HHB")  # number of moves, length of the tags, result (index in ChessPGN.RESULTS)
+OFFSET = struct.Struct(">Q")
+
+ArchivedGame = collections.namedtuple("ArchivedGame", "headers move_ids result")  # headers dict, move IDs, "1-0"...
+
+
+def encode_record(headers, move_ids, result="*"):
+    """
+    Bytes of the record of a game (the Result tag is not stored, it is the result).
+    """
+    tags = "".join(f"{name}\0{value}\0" for name, value in headers.items() if name != "Result").encode()
+    if len(move_ids) > 0xFFFF or len(tags) > 0xFFFF:
+        raise ValueError("game too long to be archived")
+    return (RECORD_HEADER.pack(len(move_ids), len(tags), ChessPGN.RESULTS.index(result)) + tags
+            + struct.pack(f">{len(move_ids)}H", *move_ids))
+
+
+def decode_record(data, offset):
+    """
+    (ArchivedGame, offset of the next record) of the record at the offset of the data (bytes or mmap).
+    """
+    move_count, tags_length, result = RECORD_HEADER.unpack_from(data, offset)
+    offset += RECORD_HEADER.size
+    fields = bytes(data[offset:offset + tags_length]).decode().split("\0")
+    offset += tags_length
+    move_ids = struct.unpack_from(f">{move_count}H", data, offset)
+    headers = dict(zip(fields[0:-1:2], fields[1::2]))
+    return ArchivedGame(headers, list(move_ids), ChessPGN.RESULTS[result]), offset + 2 * move_count
+
+
+def pgn_game_record(game):
+    """
+    Record of a ChessPGN.Game, or None if one of its moves can't be played (the moves are replayed to get their IDs).
+    """
+    gs = ChessEngine.GameState.from_fen(game.headers["FEN"]) if "FEN" in game.headers else ChessEngine.GameState()
+    move_ids = []
+    for san in game.moves:
+        try:
+            move = ChessPGN.parse_san(gs, san)
+        except ValueError:
+            return None
+        move_ids.append(move.moveID)
+        gs.make_move(move)
+    return encode_record(game.headers, move_ids, game.result)
+
+
+def game_state_record(gs, headers=None, result="*"):
+    """
+    Record of the game played on a GameState: its moves from the position before the first one.
+    """
+    start = gs.copy()
+    for _ in range(len(gs.moveLog)):
+        start.undo_move()
+    headers = dict(headers or {})
+    start_fen = start.to_fen()
+    if start_fen.split()[:4] != ChessEngine.START_FEN.split()[:4]:
+        headers.update(SetUp="1", FEN=start_fen)
+    return encode_record(headers, [move.moveID for move in gs.moveLog], result)
+
+
+def game_state(game):
+    """
+    GameState of an ArchivedGame after its moves (they are played without checking them, the archive is trusted).
+    """
+    gs = ChessEngine.GameState.from_fen(game.headers["FEN"]) if "FEN" in game.headers else ChessEngine.GameState()
+    for move_id in game.move_ids:
+        gs.make_move(Move(move_id & 63, move_id >> 6 & 63, move_id >> 12))
+    return gs
+
+
+def to_pgn_game(game):
+    """
+    ChessPGN.Game of an ArchivedGame, with the moves in SAN. Raise a ValueError if a move is not valid.
+    """
+    gs = ChessEngine.GameState.from_fen(game.headers["FEN"]) if "FEN" in game.headers else ChessEngine.GameState()
+    sans = []
+    for move_id in game.move_ids:
+        valid_moves = gs.get_cached_valid_moves()
+        move = next((move for move in valid_moves if move.moveID == move_id), None)
+        if move is None:
+            raise ValueError(f"invalid move {Move(move_id & 63, move_id >> 6 & 63).get_chess_notation()} "
+                             f"at ply {len(sans) + 1}")
+        sans.append(ChessPGN.to_san(gs, move, valid_moves))
+        gs.make_move(move)
+    return ChessPGN.Game(game.headers, sans, game.result)
+
+
+def _map(path):
+    """
+    (file, read-only mmap of it) (an empty file can't be mapped: b"" instead).
+    """
+    archive_file = open(path, "rb")
+    try:
+        return archive_file, mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        return archive_file, b""
+
+
+class GameArchive:
+    """
+    Reader of an archive: len(archive), archive[n] (an ArchivedGame) and iteration over the games.
+    The games appended after it was opened are not seen.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file, self.data = _map(path)
+        self.index_file, self.index = _map(path + ".idx")
+        if self.data[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a game archive")
+        self.size = len(self.index) // OFFSET.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, number):
+        if number < 0:
+            number += self.size
+        if not 0 <= number < self.size:
+            raise IndexError("game number out of range")
+        return decode_record(self.data, OFFSET.unpack_from(self.index, number * OFFSET.size)[0])[0]
+
+    def __iter__(self):
+        for number in range(self.size):
+            yield self[number]
+
+    def close(self):
+        for data, opened_file in ((self.data, self.file), (self.index, self.index_file)):
+            if isinstance(data, mmap.mmap):
+                data.close()
+            opened_file.close()
+
+
+class ArchiveWriter:
+    """
+    Append games to an archive (made if it doesn't exist). append... return the number of the game.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + ".idx"
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, "wb") as archive_file:
+                archive_file.write(MAGIC)
+            open(self.index_path, "wb").close()
+        self.size = self._recover()
+        self.file = open(path, "ab")
+        self.index_file = open(self.index_path, "ab")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    def _recover(self):
+        """
+        Index the records written after the last indexed one and drop an unfinished record at the end.
+        Return the number of games.
+        """
+        index_size = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
+        if index_size % OFFSET.size:  # an offset half written
+            index_size -= index_size % OFFSET.size
+            os.truncate(self.index_path, index_size)
+        archive_file, data = _map(self.path)
+        try:
+            if data[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{self.path} is not a game archive")
+            if index_size:
+                with open(self.index_path, "rb") as index_file:
+                    index_file.seek(index_size - OFFSET.size)
+                    offset = decode_record(data, OFFSET.unpack(index_file.read())[0])[1]
+            else:
+                offset = len(MAGIC)
+            offsets = []
+            while offset < len(data):
+                try:
+                    end = decode_record(data, offset)[1]
+                except (struct.error, UnicodeDecodeError, IndexError):
+                    end = len(data) + 1
+                if end > len(data):  # unfinished
+                    break
+                offsets.append(offset)
+                offset = end
+            unfinished = offset < len(data)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+            archive_file.close()
+        if unfinished:
+            os.truncate(self.path, offset)
+        if offsets:
+            with open(self.index_path, "ab") as index_file:
+                index_file.write(b"".join(OFFSET.pack(offset) for offset in offsets))
+        return index_size // OFFSET.size + len(offsets)
+
+    def append_record(self, record):
+        """
+        Append the bytes of a record (encode_record...): the record first, then its offset in the index.
+        """
+        offset = self.file.tell()
+        self.file.write(record)
+        self.file.flush()
+        self.index_file.write(OFFSET.pack(offset))
+        self.index_file.flush()
+        self.size += 1
+        return self.size - 1
+
+    def append(self, headers, move_ids, result="*"):
+        return self.append_record(encode_record(headers, move_ids, result))
+
+    def append_game_state(self, gs, headers=None, result="*"):
+        return self.append_record(game_state_record(gs, headers, result))
+
+    def close(self):
+        self.file.close()
+        self.index_file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Store games in a compact binary archive, or read them back.")
+    ChessStats.add_arguments(parser)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="append the games of a PGN file to an archive")
+    import_parser.add_argument("pgn_file")
+    import_parser.add_argument("archive_file")
+    import_parser.add_argument("--workers", type=int, default=0, help="number of worker processes (0: all the cores)")
+    show_parser = subparsers.add_parser("show", help="print games of an archive as PGN")
+    show_parser.add_argument("archive_file")
+    show_parser.add_argument("numbers", type=int, nargs="+", help="numbers of the games (from 0, -1: the last one)")
+    info_parser = subparsers.add_parser("info", help="print the number of games and the size of an archive")
+    info_parser.add_argument("archive_file")
+    args = parser.parse_args()
+
+    with ChessStats.session(args):
+        if args.command == "import":
+            start = time.perf_counter()
+            count = errors = 0
+            with open(args.pgn_file, encoding="utf-8", errors="replace") as pgn_file, \
+                    ArchiveWriter(args.archive_file) as writer:
+                for record in ChessPGN.replay_games(ChessPGN.read_games(pgn_file), pgn_game_record,
+                                                    workers=args.workers or None):
+                    if record is None:
+                        errors += 1
+                    else:
+                        writer.append_record(record)
+                        count += 1
+            print(f"{count} games archived ({errors} with an invalid move left out) in "
+                  f"{time.perf_counter() - start:.2f}s: {os.path.getsize(args.archive_file)} bytes, "
+                  f"{os.path.getsize(args.pgn_file)} bytes of PGN")
+        elif args.command == "show":
+            with GameArchive(args.archive_file) as archive:
+                for number in args.numbers:
+                    print(ChessPGN.game_to_pgn(to_pgn_game(archive[number])), end="")
+        else:
+            with GameArchive(args.archive_file) as archive:
+                plies = sum(len(game.move_ids) for game in archive)
+                size = os.path.getsize(args.archive_file) + os.path.getsize(args.archive_file + ".idx")
+                print(f"{len(archive)} games, {plies} plies, {size} bytes with the index "
+                      f"({size / max(plies, 1):.2f} bytes/ply)")
+
+
+if __name__ == "__main__":
+    main()
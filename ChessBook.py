@@ -0,0 +1,183 @@
+"""
+Opening book: a binary file of (position hash, move, weight) records sorted by hash, built from PGN games.
+The layout is the one of the Polyglot books (16 bytes big-endian records: 64 bits key, 16 bits move, 16 bits weight,
+32 bits learn), but the keys are our Zobrist hashes (GameState.zobrist_hash) and the moves our move IDs (Move.moveID).
+The file is memory-mapped and binary-searched, never loaded: every process reading the same book shares its pages.
+
+usage:
+    python ChessBook.py build games.pgn book.bin --plies 20     # compile a book from the first 20 plies of the games
+    python ChessBook.py probe book.bin --fen "<fen>"            # the book moves of a position
+"""
+
+import argparse
+import collections
+import functools
+import mmap
+import random
+import struct
+
+import ChessEngine
+import ChessPGN
+import ChessStats
+
+
+RECORD = struct.Struct(">QHHI")  # key, move, weight, learn
+KEY = struct.Struct(">Q")
+MAX_WEIGHT = 0xFFFF
+DEFAULT_PLIES = 20
+# weight of a move by the result of the game for the player who made it
+RESULT_WEIGHTS = {"win": 2, "draw": 1, "loss": 0, "unknown": 1}
+
+
+class OpeningBook:
+    """
+    Reader of a book file. get_moves(gs) gives the book moves of a position, choose_move(gs) picks one of them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # an empty file can't be mapped
+            self.data = b""
+        self.size = len(self.data) // RECORD.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def entries(self, key):
+        """
+        [(move id, weight, learn)] of the records of a hash, with a binary search for the first one.
+        """
+        data = self.data
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if KEY.unpack_from(data, middle * RECORD.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        entries = []
+        for index in range(low, self.size):
+            record_key, move_id, weight, learn = RECORD.unpack_from(data, index * RECORD.size)
+            if record_key != key:
+                break
+            entries.append((move_id, weight, learn))
+        return entries
+
+    def get_moves(self, gs):
+        """
+        [(Move, weight)] of the book moves of the position which are valid in it, the best first.
+        """
+        entries = self.entries(gs.zobrist_hash)
+        if not entries:
+            return []
+        valid_moves = {move.moveID: move for move in gs.get_cached_valid_moves()}
+        return [(valid_moves[move_id], weight) for move_id, weight, _ in entries
+                if move_id in valid_moves and weight > 0]
+
+    def choose_move(self, gs, rng=random, best=False):
+        """
+        A book move of the position picked at random in proportion to the weights (or the heaviest one if best),
+        None if the position is not in the book.
+        """
+        moves = self.get_moves(gs)
+        if not moves:
+            return None
+        if best:
+            return moves[0][0]
+        return rng.choices([move for move, _ in moves], weights=[weight for _, weight in moves])[0]
+
+
+def game_entries(game, plies=DEFAULT_PLIES):
+    """
+    [(key, move id, weight)] of the first plies of a game, the weight from the result for the player who moved.
+    Stop at the first move which can't be played.
+    """
+    if "FEN" in game.headers:
+        return []  # the book is only for the games from the starting position
+    gs = ChessEngine.GameState()
+    winner = {"1-0": "w", "0-1": "b"}.get(game.result)
+    entries = []
+    for san in game.moves[:plies]:
+        try:
+            move = ChessPGN.parse_san(gs, san)
+        except ValueError:
+            break
+        if winner is not None:
+            weight = RESULT_WEIGHTS["win" if winner == gs.color else "loss"]
+        else:
+            weight = RESULT_WEIGHTS["draw" if game.result == "1/2-1/2" else "unknown"]
+        entries.append((gs.zobrist_hash, move.moveID, weight))
+        gs.make_move(move)
+    return entries
+
+
+def build_book(games, path, plies=DEFAULT_PLIES, min_weight=1, workers=None):
+    """
+    Compile a book file from an iterable of ChessPGN.Game: the weights of the same move in the same position are
+    added up, the moves under min_weight are left out, and the weights are scaled down to fit in 16 bits.
+    Return the number of records written.
+    """
+    weights = collections.Counter()
+    function = functools.partial(game_entries, plies=plies)
+    for entries in ChessPGN.replay_games(games, function, workers=workers):
+        for key, move_id, weight in entries:
+            weights[key, move_id] += weight
+    records = [(key, move_id, weight) for (key, move_id), weight in weights.items() if weight >= min_weight]
+    scale = max([weight for _, _, weight in records], default=0) / MAX_WEIGHT
+    # by key, then the heaviest move first
+    records.sort(key=lambda record: (record[0], -record[2]))
+    with open(path, "wb") as book_file:
+        for key, move_id, weight in records:
+            if scale > 1:
+                weight = max(1, int(weight / scale))
+            book_file.write(RECORD.pack(key, move_id, weight, 0))
+    return len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an opening book from PGN games, or look a position up in it.")
+    ChessStats.add_arguments(parser)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="compile a book from a PGN file")
+    build_parser.add_argument("pgn_file")
+    build_parser.add_argument("book_file")
+    build_parser.add_argument("--plies", type=int, default=DEFAULT_PLIES, help="plies of each game to put in the book")
+    build_parser.add_argument("--min-weight", type=int, default=1, help="leave out the moves with a smaller weight")
+    build_parser.add_argument("--workers", type=int, default=0, help="number of worker processes (0: all the cores)")
+    probe_parser = subparsers.add_parser("probe", help="print the book moves of a position")
+    probe_parser.add_argument("book_file")
+    probe_parser.add_argument("--fen", help="position to look up (default: the starting position)")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        with open(args.pgn_file, encoding="utf-8", errors="replace") as pgn_file, ChessStats.session(args):
+            count = build_book(ChessPGN.read_games(pgn_file), args.book_file, args.plies, args.min_weight,
+                               args.workers or None)
+        print(f"{count} moves written to {args.book_file}")
+    else:
+        gs = ChessEngine.GameState.from_fen(args.fen) if args.fen else ChessEngine.GameState()
+        with OpeningBook(args.book_file) as book, ChessStats.session(args):
+            moves = book.get_moves(gs)
+            total = sum(weight for _, weight in moves)
+            for move, weight in moves:
+                print(f"{ChessPGN.to_san(gs, move):<8} weight {weight:>5}  {100 * weight / total:5.1f}%")
+            if not moves:
+                print("not in the book")
+
+
+if __name__ == "__main__":
+    main()
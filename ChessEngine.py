@@ -12,8 +12,8 @@ responsible for determining the valid moves at the current state. It will also k
 # the pawn can eat en passant if the enemy pawn is on the adjacent square after have moved 2 squares.
 # Rook: can move any number of squares in any direction, can be blocked by other pieces.
 # knight can move in an L shape:
-#   - 3 squares in one direction and 2 squares in an orthogonal direction
-#   - 2 squares in one direction and 3 squares in an orthogonal direction
+#   - 2 squares in one direction and 1 square in an orthogonal direction
+#   - 1 square in one direction and 2 squares in an orthogonal direction
 # Bishop: can move any number of squares diagonally.
 # Queen: can move any number of squares in any direction. (This is the same as the bishop + the rook.)
 # King: can move only 1 square in any direction, can be blocked by other pieces.
@@ -27,7 +27,347 @@ responsible for determining the valid moves at the current state. It will also k
 
 
 # TODO: Add in piece highlighting and move suggestions
-# TODO: Add in AI
+
+import collections
+import copy
+import random
+
+
+# Bitboards:
+# the squares are numbered from 0 to 63 in the same order as the board list: square = row * 8 + col.
+# So the square 0 is a8 (top left corner of the screen) and the square 63 is h1 (bottom right corner).
+# A bitboard is a python int where the bit n is set if the square n is occupied by the piece.
+# (ex: the white pawns at the start of the game are 0xFF << 48, ie the whole row 6)
+PIECES = ("wP", "wN", "wB", "wR", "wQ", "wK", "bP", "bN", "bB", "bR", "bQ", "bK")
+EMPTY = "--"
+OPPONENT = {"w": "b", "b": "w"}
+FULL = (1 << 64) - 1
+FILE_A = 0x0101010101010101
+FILE_H = FILE_A << 7
+NOT_FILE_A = FULL ^ FILE_A
+NOT_FILE_H = FULL ^ FILE_H
+ROW_MASKS = [0xFF << (8 * row) for row in range(8)]
+SQUARES = [(row, col) for row in range(8) for col in range(8)]  # square -> (row, col)
+
+KNIGHT_OFFSETS = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1))
+KING_OFFSETS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+ROOK_DIRECTIONS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+BISHOP_DIRECTIONS = ((-1, -1), (-1, 1), (1, -1), (1, 1))
+
+# castling rights are stored as 4 bits.
+WHITE_KINGSIDE = 1
+WHITE_QUEENSIDE = 2
+BLACK_KINGSIDE = 4
+BLACK_QUEENSIDE = 8
+ALL_CASTLING = 15
+# move flags (see Move): en passant, castling, or promotion + the index of the piece in PROMOTION_PIECES
+FLAG_ENPASSANT = 1
+FLAG_CASTLE = 2
+FLAG_PROMOTION = 4
+PROMOTION_PIECES = "NBRQ"
+PROMOTION_FLAGS = (FLAG_PROMOTION | 3, FLAG_PROMOTION | 2, FLAG_PROMOTION | 1, FLAG_PROMOTION)  # Q, R, B, N
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+FEN_CASTLING = (("K", WHITE_KINGSIDE), ("Q", WHITE_QUEENSIDE), ("k", BLACK_KINGSIDE), ("q", BLACK_QUEENSIDE))
+# king destination square -> (rook start square, rook end square)
+CASTLING_ROOKS = {62: (63, 61), 58: (56, 59), 6: (7, 5), 2: (0, 3)}
+
+
+def _build_leaper_attacks(offsets):
+    """
+    For each square, the bitboard of the squares reachable with one of the offsets (knight and king).
+    """
+    attacks = []
+    for row, col in SQUARES:
+        bb = 0
+        for d_row, d_col in offsets:
+            if 0 <= row + d_row < 8 and 0 <= col + d_col < 8:
+                bb |= 1 << ((row + d_row) * 8 + col + d_col)
+        attacks.append(bb)
+    return attacks
+
+
+def _build_rays(d_row, d_col):
+    """
+    For each square, the bitboard of all the squares in the direction (d_row, d_col) until the edge of the board.
+    """
+    rays = []
+    for row, col in SQUARES:
+        bb = 0
+        r, c = row + d_row, col + d_col
+        while 0 <= r < 8 and 0 <= c < 8:
+            bb |= 1 << (r * 8 + c)
+            r, c = r + d_row, c + d_col
+        rays.append(bb)
+    return rays
+
+
+KNIGHT_ATTACKS = _build_leaper_attacks(KNIGHT_OFFSETS)
+KING_ATTACKS = _build_leaper_attacks(KING_OFFSETS)
+# squares attacked by a pawn of a given color standing on a square (white pawns go up the board: row - 1)
+PAWN_ATTACKS = {"w": _build_leaper_attacks(((-1, -1), (-1, 1))), "b": _build_leaper_attacks(((1, -1), (1, 1)))}
+RAYS = {direction: _build_rays(*direction) for direction in ROOK_DIRECTIONS + BISHOP_DIRECTIONS}
+# (rays, True if the ray goes toward the higher squares) so the first blocker is the lowest or the highest bit.
+ROOK_RAYS = tuple((RAYS[d], d[0] * 8 + d[1] > 0) for d in ROOK_DIRECTIONS)
+BISHOP_RAYS = tuple((RAYS[d], d[0] * 8 + d[1] > 0) for d in BISHOP_DIRECTIONS)
+QUEEN_RAYS = ROOK_RAYS + BISHOP_RAYS
+
+
+def _build_between():
+    """
+    BETWEEN[a][b]: bitboard of the squares strictly between 2 squares on the same row, column or diagonal (0 if they
+    are not aligned or next to each other).
+    """
+    between = [[0] * 64 for _ in range(64)]
+    for d_row, d_col in ROOK_DIRECTIONS + BISHOP_DIRECTIONS:
+        for row, col in SQUARES:
+            bb = 0
+            r, c = row + d_row, col + d_col
+            while 0 <= r < 8 and 0 <= c < 8:
+                between[row * 8 + col][r * 8 + c] = bb
+                bb |= 1 << (r * 8 + c)
+                r, c = r + d_row, c + d_col
+    return between
+
+
+BETWEEN = _build_between()
+
+
+def _build_targets(offsets, rows=range(8)):
+    """
+    For each square, the tuple of the squares reachable with the offsets, in the order of the offsets (empty for the
+    squares not on the given rows).
+    """
+    targets = []
+    for row, col in SQUARES:
+        targets.append(tuple((row + d_row) * 8 + col + d_col for d_row, d_col in offsets
+                             if row in rows and 0 <= row + d_row < 8 and 0 <= col + d_col < 8))
+    return tuple(targets)
+
+
+def _build_ray_lists(d_row, d_col):
+    """
+    For each square, the tuple of the squares in the direction (d_row, d_col), from the nearest to the edge.
+    """
+    ray_lists = []
+    for row, col in SQUARES:
+        squares = []
+        r, c = row + d_row, col + d_col
+        while 0 <= r < 8 and 0 <= c < 8:
+            squares.append(r * 8 + c)
+            r, c = r + d_row, c + d_col
+        ray_lists.append(tuple(squares))
+    return tuple(ray_lists)
+
+
+# The same moves as lists of squares, for the per-piece generator (get_possibles_moves2): it only loops over them.
+KNIGHT_TARGETS = _build_targets(KNIGHT_OFFSETS)
+KING_TARGETS = _build_targets(KING_OFFSETS)
+# pawn pushes (1 square, then 2 from the starting row: stop at the first blocked one) and captures, per color
+PAWN_PUSHES = {"w": tuple(single + double for single, double in zip(_build_targets(((-1, 0),), range(1, 7)),
+                                                                    _build_targets(((-2, 0),), (6,)))),
+               "b": tuple(single + double for single, double in zip(_build_targets(((1, 0),), range(1, 7)),
+                                                                    _build_targets(((2, 0),), (1,))))}
+PAWN_CAPTURES = {"w": _build_targets(((-1, -1), (-1, 1)), range(1, 7)),
+                 "b": _build_targets(((1, -1), (1, 1)), range(1, 7))}
+RAY_LISTS = {direction: _build_ray_lists(*direction) for direction in ROOK_DIRECTIONS + BISHOP_DIRECTIONS}
+# for each square, the ray lists of a piece (one tuple of squares per direction)
+ROOK_RAY_LISTS = tuple(tuple(RAY_LISTS[d][square] for d in ROOK_DIRECTIONS) for square in range(64))
+BISHOP_RAY_LISTS = tuple(tuple(RAY_LISTS[d][square] for d in BISHOP_DIRECTIONS) for square in range(64))
+QUEEN_RAY_LISTS = tuple(rook + bishop for rook, bishop in zip(ROOK_RAY_LISTS, BISHOP_RAY_LISTS))
+
+# castling rights kept when a move starts or ends on a square (moving the king or a rook, or capturing a rook)
+CASTLE_MASKS = [ALL_CASTLING] * 64
+CASTLE_MASKS[60] = ALL_CASTLING ^ (WHITE_KINGSIDE | WHITE_QUEENSIDE)
+CASTLE_MASKS[63] = ALL_CASTLING ^ WHITE_KINGSIDE
+CASTLE_MASKS[56] = ALL_CASTLING ^ WHITE_QUEENSIDE
+CASTLE_MASKS[4] = ALL_CASTLING ^ (BLACK_KINGSIDE | BLACK_QUEENSIDE)
+CASTLE_MASKS[7] = ALL_CASTLING ^ BLACK_KINGSIDE
+CASTLE_MASKS[0] = ALL_CASTLING ^ BLACK_QUEENSIDE
+
+# Zobrist hashing: a random 64 bits key for each (piece, square), castling rights, en passant file and side to move.
+# The hash of a position is the xor of the keys of what is in it, so a move only xors in and out what it changes.
+# The seed is fixed so every process gives the same hash to the same position.
+_zobrist_random = random.Random(2022)
+ZOBRIST_PIECES = {piece: [_zobrist_random.getrandbits(64) for _ in range(64)] for piece in PIECES}
+ZOBRIST_CASTLING = [_zobrist_random.getrandbits(64) for _ in range(16)]
+ZOBRIST_ENPASSANT = [_zobrist_random.getrandbits(64) for _ in range(8)]  # by file, only if a capture is possible
+ZOBRIST_BLACK_TO_MOVE = _zobrist_random.getrandbits(64)
+
+# Evaluation terms: the material and piece-square values, kept up to date by make_move and undo_move like the hash, so
+# ChessEval.evaluate doesn't have to go over the board. The middlegame and endgame values are tapered by the phase (the
+# weights of the pieces left: 24 with all of them, 0 with only kings and pawns).
+PIECE_VALUES = {"P": 100, "N": 320, "B": 330, "R": 500, "Q": 900, "K": 0}
+
+# Piece-square tables (middlegame): bonus of a piece on a square, for the white pieces and in the board order (row 0 is
+# the 8th rank, at the top). The black pieces use the table upside down (square ^ 56 flips the row).
+# values from https://www.chessprogramming.org/Simplified_Evaluation_Function
+PIECE_SQUARE_TABLES = {
+    "P": [
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0,
+    ],
+    "N": [
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50,
+    ],
+    "B": [
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20,
+    ],
+    "R": [
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0,
+    ],
+    "Q": [
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20,
+    ],
+    "K": [
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20,
+    ],
+}
+
+# Endgame tables: the same but for the king, which must come to the center, and the pawns, which must run.
+ENDGAME_PIECE_SQUARE_TABLES = dict(PIECE_SQUARE_TABLES, P=[
+    0, 0, 0, 0, 0, 0, 0, 0,
+    80, 80, 80, 80, 80, 80, 80, 80,
+    50, 50, 50, 50, 50, 50, 50, 50,
+    30, 30, 30, 30, 30, 30, 30, 30,
+    15, 15, 15, 15, 15, 15, 15, 15,
+    5, 5, 5, 5, 5, 5, 5, 5,
+    0, 0, 0, 0, 0, 0, 0, 0,
+    0, 0, 0, 0, 0, 0, 0, 0,
+], K=[
+    -50, -40, -30, -20, -20, -30, -40, -50,
+    -30, -20, -10, 0, 0, -10, -20, -30,
+    -30, -10, 20, 30, 30, 20, -10, -30,
+    -30, -10, 30, 40, 40, 30, -10, -30,
+    -30, -10, 30, 40, 40, 30, -10, -30,
+    -30, -10, 20, 30, 30, 20, -10, -30,
+    -30, -30, 0, 0, 0, 0, -30, -30,
+    -50, -30, -30, -30, -30, -30, -30, -50,
+])
+PHASE_WEIGHTS = {"P": 0, "N": 1, "B": 1, "R": 2, "Q": 4, "K": 0}
+PHASE_MAX = 24
+
+
+def pack_score(mg, eg):
+    """
+    The middlegame and endgame values in one int (eg * 2**16 + mg), so one addition updates both.
+    """
+    return (eg << 16) + mg
+
+
+def unpack_score(score):
+    """
+    (mg, eg) of a packed score (both must stay within +-32767).
+    """
+    mg = ((score + 0x8000) & 0xFFFF) - 0x8000
+    return mg, (score - mg) >> 16
+
+
+def _build_psq():
+    """
+    For each piece, the packed (material + table) values of each square, positive for white and negative for black.
+    """
+    psq = {}
+    for piece in PIECES:
+        color, kind = piece
+        values = []
+        for square in range(64):
+            table_square = square if color == "w" else square ^ 56
+            score = pack_score(PIECE_VALUES[kind] + PIECE_SQUARE_TABLES[kind][table_square],
+                               PIECE_VALUES[kind] + ENDGAME_PIECE_SQUARE_TABLES[kind][table_square])
+            values.append(score if color == "w" else -score)
+        psq[piece] = values
+    return psq
+
+
+PSQ = _build_psq()
+PIECE_PHASES = {piece: PHASE_WEIGHTS[piece[1]] for piece in PIECES}
+
+# what the legal move generation needs to know about the enemy pieces (see GameState.get_attack_info):
+# attacked: squares attacked by the opponent (seen through our king, so the king can't step back along a check line)
+# checkers: bitboard of the enemy pieces giving check
+# pinned: {square of our pinned piece: bitboard of the squares it can still go to (toward the king or the pinner)}
+AttackInfo = collections.namedtuple("AttackInfo", "attacked checkers pinned")
+
+
+def sliding_attacks(square, occupied, rays):
+    """
+    Squares attacked by a slider on a square, along the given rays, stopping at the first blocker (included).
+    """
+    attacks = 0
+    for ray_table, forward in rays:
+        ray = ray_table[square]
+        blockers = ray & occupied
+        if blockers:
+            if forward:
+                blocker = (blockers & -blockers).bit_length() - 1
+            else:
+                blocker = blockers.bit_length() - 1
+            ray ^= ray_table[blocker]
+        attacks |= ray
+    return attacks
+
+
+def rook_attacks(square, occupied):
+    return sliding_attacks(square, occupied, ROOK_RAYS)
+
+
+def bishop_attacks(square, occupied):
+    return sliding_attacks(square, occupied, BISHOP_RAYS)
+
+
+def queen_attacks(square, occupied):
+    return sliding_attacks(square, occupied, QUEEN_RAYS)
+
+
+def iter_squares(bb):
+    """
+    Yield the squares of the set bits of a bitboard, from the lowest to the highest.
+    """
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
 
 
 class GameState:
@@ -37,6 +377,7 @@ class GameState:
         # The 2nd char is the type of the piece
         # "--" is a blank square (empty space/square with no pieces on it)
         # (Can be also done with numpy arrays (for IA purposes))
+        # The position is stored in bitboards (one int per piece, see above), the board list is only a view of them.
         self.board = [
             ["bR", "bN", "bB", "bQ", "bK", "bB", "bN", "bR"],
             ["bP", "bP", "bP", "bP", "bP", "bP", "bP", "bP"],
@@ -50,121 +391,620 @@ class GameState:
         self.whiteToMove = True
         self.color = "w"
         self.moveLog = []
+        # what a move can't tell by itself to be undone: (captured piece, castling rights, en passant square,
+        # halfmove clock, hash, psq, phase) before each move of the move log.
+        self.stateLog = []
+        self.checkmate = False
+        self.stalemate = False
+
+    @property
+    def board(self):
+        """
+        The 8*8 list of strings view of the position. It is derived from the bitboards only when asked for and kept
+        until the next move, so don't modify it in place: assign a new 8*8 list to `board` to set up a position.
+        """
+        if self._board is None:
+            squares = [EMPTY] * 64
+            for piece, bb in self.bitboards.items():
+                for square in iter_squares(bb):
+                    squares[square] = piece
+            self._board = [squares[row * 8:row * 8 + 8] for row in range(8)]
+        return self._board
+
+    @board.setter
+    def board(self, board):
+        self.bitboards = dict.fromkeys(PIECES, 0)
+        self.mailbox = [EMPTY] * 64  # piece on each square, to know what is captured without scanning the bitboards
+        for row in range(8):
+            for col in range(8):
+                piece = board[row][col]
+                if piece != EMPTY:
+                    self.bitboards[piece] |= 1 << (row * 8 + col)
+                    self.mailbox[row * 8 + col] = piece
+        self.occupancy = {color: 0 for color in "wb"}
+        for piece, bb in self.bitboards.items():
+            self.occupancy[piece[0]] |= bb
+        # the castling rights are given only if the king and the rook are on their starting squares.
+        self.castle_rights = 0
+        for right, king_sq, rook_sq, color in ((WHITE_KINGSIDE, 60, 63, "w"), (WHITE_QUEENSIDE, 60, 56, "w"),
+                                               (BLACK_KINGSIDE, 4, 7, "b"), (BLACK_QUEENSIDE, 4, 0, "b")):
+            if self.mailbox[king_sq] == color + "K" and self.mailbox[rook_sq] == color + "R":
+                self.castle_rights |= right
+        self.enpassant_sq = None  # square behind a pawn which has just moved 2 squares
+        self.halfmove_clock = 0  # moves since the last capture or pawn move (fifty-move rule)
+        self.fullmove_number = 1  # starts at 1 and is incremented after each black move
+        self.king_sq = {color: self.bitboards[color + "K"].bit_length() - 1 for color in "wb"}
+        self._attack_info = None  # (hash, AttackInfo) of the last position get_attack_info was asked for
+        self.whiteToMove = True
+        self.color = "w"
+        self.compute_hash()
+        self.compute_psq()
+        self.reset_history()
+        self._board = [list(row) for row in board]
+
+    def compute_hash(self):
+        """
+        Compute the Zobrist hash of the position from scratch. make_move and undo_move keep it up to date, call this
+        only after changing the position by hand (ex: whiteToMove, castle_rights or enpassant_sq).
+        """
+        zobrist_hash = 0
+        for piece, bb in self.bitboards.items():
+            for square in iter_squares(bb):
+                zobrist_hash ^= ZOBRIST_PIECES[piece][square]
+        zobrist_hash ^= ZOBRIST_CASTLING[self.castle_rights]
+        if self.enpassant_sq is not None and PAWN_ATTACKS[OPPONENT[self.color]][self.enpassant_sq] & self.bitboards[
+                self.color + "P"]:
+            zobrist_hash ^= ZOBRIST_ENPASSANT[self.enpassant_sq % 8]
+        if not self.whiteToMove:
+            zobrist_hash ^= ZOBRIST_BLACK_TO_MOVE
+        self.zobrist_hash = zobrist_hash
+        return zobrist_hash
 
-    def make_move(self, move):  # TODO: add in castling, en passant, pawn promotion.
-        self.board[move.start_row][move.start_col] = "--"
-        self.board[move.end_row][move.end_col] = move.piece_moved
+    def compute_psq(self):
+        """
+        Compute the evaluation terms from scratch: psq, the sum of the packed PSQ values of the pieces, and phase, the
+        sum of their PIECE_PHASES. make_move and undo_move keep them up to date.
+        """
+        psq = phase = 0
+        for piece, bb in self.bitboards.items():
+            values = PSQ[piece]
+            for square in iter_squares(bb):
+                psq += values[square]
+                phase += PIECE_PHASES[piece]
+        self.psq = psq
+        self.phase = phase
+
+    def reset_history(self):
+        """
+        Forget the positions played before the current one (after setting up a position).
+        The history is {hash: times seen} of the positions since the last capture or pawn move: no position before it
+        can come back. Such a move starts a new dict and the old one is kept in position_counts_log for undo_move.
+        """
+        self.position_counts = {self.zobrist_hash: 1}
+        self.position_counts_log = []
+
+    def is_repetition(self, count=3):
+        """
+        Check if the current position has been seen `count` times (this time included).
+        """
+        return self.position_counts.get(self.zobrist_hash, 0) >= count
+
+    def is_insufficient_material(self):
+        """
+        Neither player can checkmate: only the kings, with at most one knight or bishop.
+        """
+        bitboards = self.bitboards
+        for piece in ("P", "R", "Q"):
+            if bitboards["w" + piece] or bitboards["b" + piece]:
+                return False
+        minors = bitboards["wN"] | bitboards["wB"] | bitboards["bN"] | bitboards["bB"]
+        return not minors & (minors - 1)
+
+    def get_draw_reason(self):
+        """
+        "threefold repetition", "fifty-move rule" or "insufficient material" if the game is a draw by one of these
+        rules, else None. (stalemate and checkmate are found by getValidMoves, and a checkmate comes first)
+        """
+        if self.is_repetition(3):
+            return "threefold repetition"
+        if self.halfmove_clock >= 100:
+            return "fifty-move rule"
+        if self.is_insufficient_material():
+            return "insufficient material"
+        return None
+
+    @classmethod
+    def from_fen(cls, fen):
+        """
+        New GameState from a FEN string (ex: START_FEN).
+        """
+        gs = cls.__new__(cls)  # set_fen sets everything up: not the starting position first
+        gs.set_fen(fen)
+        return gs
+
+    def set_fen(self, fen):
+        """
+        Set up the position of a FEN string: board, side to move, castling rights, en passant square and move
+        counters. The move log is cleared. The castling rights the pieces don't allow and an en passant square with no
+        pawn which has just moved through it are dropped. Raise a ValueError if the FEN is malformed.
+        """
+        fields = fen.split()
+        if len(fields) < 4 or len(fields[0].split("/")) != 8 or fields[1] not in ("w", "b"):
+            raise ValueError(f"invalid FEN: {fen!r}")
+        board = []
+        for rank in fields[0].split("/"):
+            row = []
+            for char in rank:
+                if char.isdigit():
+                    row += [EMPTY] * int(char)
+                elif char.upper() in "PNBRQK":
+                    row.append(("w" if char.isupper() else "b") + char.upper())
+                else:
+                    raise ValueError(f"invalid FEN: {fen!r}")
+            if len(row) != 8:
+                raise ValueError(f"invalid FEN: {fen!r}")
+            board.append(row)
+        self.board = board
+        self.whiteToMove = fields[1] == "w"
+        self.color = fields[1]
+        # the board setter gave the rights the pieces allow: keep only those of them the FEN gives too.
+        castle_rights = 0
+        for char, right in FEN_CASTLING:
+            if char in fields[2]:
+                castle_rights |= right
+        self.castle_rights &= castle_rights
+        if fields[3] != "-":
+            enpassant = fields[3]
+            if len(enpassant) != 2 or enpassant[0] not in Move.files_to_col or enpassant[1] not in Move.ranks_to_row:
+                raise ValueError(f"invalid FEN: {fen!r}")
+            square = Move.ranks_to_row[enpassant[1]] * 8 + Move.files_to_col[enpassant[0]]
+            # only if a pawn of the opponent has just moved 2 squares through it, else the field is dropped
+            row, pawn_sq = (2, square + 8) if self.whiteToMove else (5, square - 8)
+            if square // 8 == row and self.mailbox[square] == EMPTY and \
+                    self.mailbox[pawn_sq] == OPPONENT[self.color] + "P":
+                self.enpassant_sq = square
+        if len(fields) > 5:
+            self.halfmove_clock = int(fields[4])
+            self.fullmove_number = int(fields[5])
+        self.moveLog = []
+        self.stateLog = []
+        self.checkmate = self.stalemate = False
+        self.compute_hash()
+        self.compute_psq()
+        self.reset_history()
+
+    def set_pieces(self, pieces, white_to_move=True):
+        """
+        Set up a position from (piece, square) pairs, with no castling right and no en passant square. Much faster
+        than assigning a board, for the tools which go through millions of positions (ex: the tablebase builder).
+        """
+        self.bitboards = dict.fromkeys(PIECES, 0)
+        self.mailbox = [EMPTY] * 64
+        self.occupancy = {"w": 0, "b": 0}
+        for piece, square in pieces:
+            self.bitboards[piece] |= 1 << square
+            self.occupancy[piece[0]] |= 1 << square
+            self.mailbox[square] = piece
+        self.king_sq = {color: self.bitboards[color + "K"].bit_length() - 1 for color in "wb"}
+        self.castle_rights = 0
+        self.enpassant_sq = None
+        self.halfmove_clock = 0
+        self.fullmove_number = 1
+        self.whiteToMove = white_to_move
+        self.color = "w" if white_to_move else "b"
+        self.moveLog = []
+        self.stateLog = []
+        self.checkmate = self.stalemate = False
+        self._board = None
+        self.compute_hash()
+        self.compute_psq()
+        self.reset_history()
+
+    def to_fen(self):
+        """
+        FEN string of the current position.
+        """
+        ranks = []
+        for row in range(8):
+            rank = ""
+            empty_count = 0
+            for piece in self.mailbox[row * 8:row * 8 + 8]:
+                if piece == EMPTY:
+                    empty_count += 1
+                    continue
+                if empty_count:
+                    rank += str(empty_count)
+                    empty_count = 0
+                rank += piece[1] if piece[0] == "w" else piece[1].lower()
+            ranks.append(rank + (str(empty_count) if empty_count else ""))
+        castling = "".join(char for char, right in FEN_CASTLING if self.castle_rights & right) or "-"
+        if self.enpassant_sq is None:
+            enpassant = "-"
+        else:
+            enpassant = Move.cols_to_file[self.enpassant_sq % 8] + Move.rows_to_rank[self.enpassant_sq // 8]
+        return (f"{'/'.join(ranks)} {self.color} {castling} {enpassant} {self.halfmove_clock} "
+                f"{self.fullmove_number}")
+
+    def copy(self):
+        """
+        Independent copy of the game (position and move log), much cheaper than setting up a new one.
+        """
+        gs = copy.copy(self)
+        gs.bitboards = dict(self.bitboards)
+        gs.mailbox = list(self.mailbox)
+        gs.occupancy = dict(self.occupancy)
+        gs.king_sq = dict(self.king_sq)
+        gs.moveLog = list(self.moveLog)
+        gs.stateLog = list(self.stateLog)
+        gs.position_counts = dict(self.position_counts)
+        gs.position_counts_log = [dict(counts) for counts in self.position_counts_log]
+        gs._board = None
+        return gs
+
+    def make_move(self, move):
+        bitboards = self.bitboards
+        mailbox = self.mailbox
+        occupancy = self.occupancy
+        us = self.color
+        them = OPPONENT[us]
+        move_id = move.moveID
+        start = move_id & 63
+        end = move_id >> 6 & 63
+        flags = move_id >> 12
+        piece = mailbox[start]
+        start_end = (1 << start) | (1 << end)
+        zobrist_hash = self.zobrist_hash
+        enpassant_sq = self.enpassant_sq
+        if enpassant_sq is not None and PAWN_ATTACKS[them][enpassant_sq] & bitboards[us + "P"]:
+            zobrist_hash ^= ZOBRIST_ENPASSANT[enpassant_sq % 8]
+
+        bitboards[piece] ^= start_end
+        occupancy[us] ^= start_end
+        keys = ZOBRIST_PIECES[piece]
+        zobrist_hash ^= keys[start] ^ keys[end]
+        values = PSQ[piece]
+        psq = self.psq + values[end] - values[start]
+        phase = self.phase
+        if flags == FLAG_ENPASSANT:
+            captured = them + "P"
+            captured_sq = end + 8 if us == "w" else end - 8
+            bitboards[captured] ^= 1 << captured_sq
+            occupancy[them] ^= 1 << captured_sq
+            mailbox[captured_sq] = EMPTY
+            zobrist_hash ^= ZOBRIST_PIECES[captured][captured_sq]
+            psq -= PSQ[captured][captured_sq]
+        else:
+            captured = mailbox[end]
+            if captured != EMPTY:
+                bitboards[captured] ^= 1 << end
+                occupancy[them] ^= 1 << end
+                zobrist_hash ^= ZOBRIST_PIECES[captured][end]
+                psq -= PSQ[captured][end]
+                phase -= PIECE_PHASES[captured]
+        mailbox[start] = EMPTY
+        mailbox[end] = piece
+        if flags & FLAG_PROMOTION:
+            promoted = us + PROMOTION_PIECES[flags & 3]
+            bitboards[piece] ^= 1 << end
+            bitboards[promoted] |= 1 << end
+            mailbox[end] = promoted
+            zobrist_hash ^= keys[end] ^ ZOBRIST_PIECES[promoted][end]
+            psq += PSQ[promoted][end] - values[end]
+            phase += PIECE_PHASES[promoted]
+        elif piece[1] == "K":
+            self.king_sq[us] = end
+            if flags == FLAG_CASTLE:
+                rook = us + "R"
+                rook_start, rook_end = CASTLING_ROOKS[end]
+                rook_bits = (1 << rook_start) | (1 << rook_end)
+                bitboards[rook] ^= rook_bits
+                occupancy[us] ^= rook_bits
+                mailbox[rook_start] = EMPTY
+                mailbox[rook_end] = rook
+                zobrist_hash ^= ZOBRIST_PIECES[rook][rook_start] ^ ZOBRIST_PIECES[rook][rook_end]
+                psq += PSQ[rook][rook_end] - PSQ[rook][rook_start]
+
+        self.stateLog.append((captured, self.castle_rights, enpassant_sq, self.halfmove_clock, self.zobrist_hash,
+                              self.psq, self.phase))
+        self.psq = psq
+        self.phase = phase
+        castle_rights = self.castle_rights & CASTLE_MASKS[start] & CASTLE_MASKS[end]
+        if castle_rights != self.castle_rights:
+            zobrist_hash ^= ZOBRIST_CASTLING[self.castle_rights] ^ ZOBRIST_CASTLING[castle_rights]
+            self.castle_rights = castle_rights
+        if piece[1] == "P":
+            self.halfmove_clock = 0
+            if abs(end - start) == 16:
+                enpassant_sq = (start + end) // 2
+                if PAWN_ATTACKS[us][enpassant_sq] & bitboards[them + "P"]:
+                    zobrist_hash ^= ZOBRIST_ENPASSANT[enpassant_sq % 8]
+                self.enpassant_sq = enpassant_sq
+            else:
+                self.enpassant_sq = None
+        else:
+            self.halfmove_clock = 0 if captured != EMPTY else self.halfmove_clock + 1
+            self.enpassant_sq = None
+        zobrist_hash ^= ZOBRIST_BLACK_TO_MOVE
+        self.zobrist_hash = zobrist_hash
+        if self.halfmove_clock == 0:
+            self.position_counts_log.append(self.position_counts)
+            self.position_counts = {zobrist_hash: 1}
+        else:
+            self.position_counts[zobrist_hash] = self.position_counts.get(zobrist_hash, 0) + 1
+        if us == "b":
+            self.fullmove_number += 1
         self.moveLog.append(move)  # Add move to move log, so we can undo it later if needed.
         self.whiteToMove = not self.whiteToMove  # Switch to other player's turn.
+        self.color = them
+        self._board = None
 
     def getValidMoves(self):
         """
-        All moves considering checks
+        All moves considering checks. The pseudo-legal moves are filtered with the attack info of the position
+        (attacked squares, checkers and pins) instead of making and undoing each of them.
+        """
+        attacked, checkers, pinned = self.get_attack_info()
+        king = self.king_sq[self.color]
+        if not checkers:
+            evasions = FULL
+        elif checkers & (checkers - 1):
+            evasions = 0  # double check: only the king can move
+        else:
+            # capture the checking piece or put something between it and the king
+            evasions = checkers | BETWEEN[king][checkers.bit_length() - 1]
+        valid_moves = []
+        append = valid_moves.append
+        for move in self.get_possibles_moves():
+            move_id = move.moveID
+            start = move_id & 63
+            end = move_id >> 6 & 63
+            if start == king:
+                # castling is only generated when the king doesn't cross an attacked square
+                if move_id >> 12 == FLAG_CASTLE or not attacked >> end & 1:
+                    append(move)
+            elif move_id >> 12 == FLAG_ENPASSANT:
+                # 2 pawns leave the row at once (a rook can see the king through them): make it and look
+                if self.is_legal(move):
+                    append(move)
+            elif evasions >> end & 1 and (start not in pinned or pinned[start] >> end & 1):
+                append(move)
+        self.checkmate = self.stalemate = False
+        if not valid_moves:
+            if checkers:
+                self.checkmate = True
+            else:
+                self.stalemate = True
+        return valid_moves
+
+    def get_cached_valid_moves(self, cache=None):
+        """
+        Same as getValidMoves, through a MoveCache (by default the shared MOVE_CACHE): a position seen before (after an
+        undo, going back and forth in a game, the same opening in many games) doesn't generate its moves again.
+        """
+        entry = (MOVE_CACHE if cache is None else cache).lookup(self)
+        self.checkmate = entry.checkmate
+        self.stalemate = entry.stalemate
+        return list(entry.moves)
+
+    def attack_map(self, color, occupied=None):
+        """
+        Bitboard of all the squares attacked by the pieces of a color, the sliders stopping at the pieces of
+        `occupied` (by default all the pieces on the board).
         """
-        # WorkInProgress
-        return self.get_possibles_moves_for_a_piece2()  # for now, we will not worry about checks and co.
+        bitboards = self.bitboards
+        if occupied is None:
+            occupied = self.occupancy["w"] | self.occupancy["b"]
+        pawns = bitboards[color + "P"]
+        if color == "w":
+            attacked = ((pawns & NOT_FILE_A) >> 9) | ((pawns & NOT_FILE_H) >> 7)
+        else:
+            attacked = (((pawns & NOT_FILE_A) << 7) | ((pawns & NOT_FILE_H) << 9)) & FULL
+        attacked |= KING_ATTACKS[self.king_sq[color]] if bitboards[color + "K"] else 0
+        bb = bitboards[color + "N"]
+        while bb:
+            low = bb & -bb
+            attacked |= KNIGHT_ATTACKS[low.bit_length() - 1]
+            bb ^= low
+        queens = bitboards[color + "Q"]
+        for bb, rays in ((bitboards[color + "R"] | queens, ROOK_RAYS), (bitboards[color + "B"] | queens, BISHOP_RAYS)):
+            while bb:
+                low = bb & -bb
+                attacked |= sliding_attacks(low.bit_length() - 1, occupied, rays)
+                bb ^= low
+        return attacked
+
+    def get_attack_info(self):
+        """
+        AttackInfo(attacked, checkers, pinned) of the opponent of the player to move. It is computed once per position
+        and kept with its hash, so asking again (is_in_check after getValidMoves...) costs nothing.
+        """
+        zobrist_hash = self.zobrist_hash
+        if self._attack_info is not None and self._attack_info[0] == zobrist_hash:
+            return self._attack_info[1]
+        bitboards = self.bitboards
+        us = self.color
+        them = OPPONENT[us]
+        king = self.king_sq[us]
+        own = self.occupancy[us]
+        enemy = self.occupancy[them]
+        occupied = own | enemy
+        # the king is taken off the board: it can't escape a slider by stepping back on the same line
+        attacked = self.attack_map(them, occupied ^ (1 << king))
+        queens = bitboards[them + "Q"]
+        rook_sliders = bitboards[them + "R"] | queens
+        bishop_sliders = bitboards[them + "B"] | queens
+        checkers = ((PAWN_ATTACKS[us][king] & bitboards[them + "P"]) | (KNIGHT_ATTACKS[king] & bitboards[them + "N"]))
+        pinned = {}
+        # the enemy sliders which would see the king if our pieces weren't there
+        snipers = ((sliding_attacks(king, enemy, ROOK_RAYS) & rook_sliders)
+                   | (sliding_attacks(king, enemy, BISHOP_RAYS) & bishop_sliders))
+        while snipers:
+            low = snipers & -snipers
+            sniper = low.bit_length() - 1
+            snipers ^= low
+            blockers = BETWEEN[king][sniper] & own
+            if not blockers:
+                checkers |= low
+            elif not blockers & (blockers - 1):  # only one of our pieces in the way: it is pinned
+                pinned[blockers.bit_length() - 1] = BETWEEN[king][sniper] | low
+        info = AttackInfo(attacked, checkers, pinned)
+        self._attack_info = (zobrist_hash, info)
+        return info
+
+    def is_legal(self, move):
+        """
+        Check if a move of get_possibles_moves doesn't leave the king of the player in check.
+        """
+        us = self.color
+        self.make_move(move)
+        legal = not self.is_square_attacked(self.king_sq[us], OPPONENT[us])
+        self.undo_move()
+        return legal
 
     def get_possibles_moves(self):
-        # moves = self.get_possibles_moves()
-        # ↑issue at: self.start_row = start_sq[0] it crash with error: TypeError: 'int' object is not subscriptable
-        possibles_moves = []  # we let it let empty for now TODO: assign moves to the method which will return the moves.
-        for row in range(8):
-            for col in range(8):
-                turn = self.board[row][col][0]
-                if (turn == "w" and self.whiteToMove) and (turn == "b" and not self.whiteToMove):
-                    piece_name = self.board[row][col][1]
-                    if piece_name == "P":
-                        possibles_moves.extend(self.get_possibles_moves_for_pawn(row, col, possibles_moves))
-                    elif piece_name == "R":
-                        possibles_moves.extend(self.get_possibles_moves_for_rook(row, col, possibles_moves))
-                    elif piece_name == "N":
-                        possibles_moves.extend(self.get_possibles_moves_for_knight(row, col, possibles_moves))
-                    elif piece_name == "B":
-                        possibles_moves.extend(self.get_possibles_moves_for_bishop(row, col, possibles_moves))
-                    elif piece_name == "Q":
-                        possibles_moves.extend(self.get_possibles_moves_for_queen(row, col, possibles_moves))
-                    elif piece_name == "K":
-                        possibles_moves.extend(self.get_possibles_moves_for_king(row, col, possibles_moves))
+        """
+        All the moves of the current player without considering checks, generated from the bitboards.
+        """
+        possibles_moves = []
+        append = possibles_moves.append
+        bitboards = self.bitboards
+        us = self.color
+        them = OPPONENT[us]
+        own = self.occupancy[us]
+        enemy = self.occupancy[them]
+        occupied = own | enemy
+        empty = FULL ^ occupied
+        not_own = FULL ^ own
+
+        # pawns: pushes and captures are computed for all the pawns at once by shifting the bitboard.
+        pawns = bitboards[us + "P"]
+        if us == "w":
+            single = (pawns >> 8) & empty
+            double = ((single & ROW_MASKS[5]) >> 8) & empty
+            targets = ((single, 8), (double, 16), (((pawns & NOT_FILE_A) >> 9) & enemy, 9),
+                       (((pawns & NOT_FILE_H) >> 7) & enemy, 7))
+            promotion_row = ROW_MASKS[0]
+        else:
+            single = (pawns << 8) & empty
+            double = ((single & ROW_MASKS[2]) << 8) & empty
+            targets = ((single, -8), (double, -16), (((pawns & NOT_FILE_A) << 7) & enemy, -7),
+                       (((pawns & NOT_FILE_H) << 9) & enemy, -9))
+            promotion_row = ROW_MASKS[7]
+        for bb, offset in targets:
+            for end in iter_squares(bb & promotion_row):
+                for flags in PROMOTION_FLAGS:
+                    append(Move(end + offset, end, flags))
+            for end in iter_squares(bb & ~promotion_row):
+                append(Move(end + offset, end))
+        if self.enpassant_sq is not None:
+            for start in iter_squares(PAWN_ATTACKS[them][self.enpassant_sq] & pawns):
+                append(Move(start, self.enpassant_sq, FLAG_ENPASSANT))
+
+        # pieces: knights and king from the precomputed tables, sliders from the rays.
+        for piece_name, table, rays in (("N", KNIGHT_ATTACKS, None), ("B", None, BISHOP_RAYS), ("R", None, ROOK_RAYS),
+                                        ("Q", None, QUEEN_RAYS), ("K", KING_ATTACKS, None)):
+            for start in iter_squares(bitboards[us + piece_name]):
+                bb = table[start] if rays is None else sliding_attacks(start, occupied, rays)
+                for end in iter_squares(bb & not_own):
+                    append(Move(start, end))
+
+        self.get_castling_moves(possibles_moves)
+        return possibles_moves
+
+    def get_castling_moves(self, possibles_moves):
+        """
+        Castling: the squares between the king and the rook are empty and the king doesn't cross an attacked square.
+        """
+        append = possibles_moves.append
+        us = self.color
+        them = OPPONENT[us]
+        occupied = self.occupancy["w"] | self.occupancy["b"]
+        rights = self.castle_rights
+        if us == "w":
+            kingside, queenside, king_sq = WHITE_KINGSIDE, WHITE_QUEENSIDE, 60
+        else:
+            kingside, queenside, king_sq = BLACK_KINGSIDE, BLACK_QUEENSIDE, 4
+        if rights & (kingside | queenside) and not self.is_square_attacked(king_sq, them):
+            if (rights & kingside and not occupied & (0b11 << (king_sq + 1))
+                    and not self.is_square_attacked(king_sq + 1, them)
+                    and not self.is_square_attacked(king_sq + 2, them)):
+                append(Move(king_sq, king_sq + 2, FLAG_CASTLE))
+            if (rights & queenside and not occupied & (0b111 << (king_sq - 3))
+                    and not self.is_square_attacked(king_sq - 1, them)
+                    and not self.is_square_attacked(king_sq - 2, them)):
+                append(Move(king_sq, king_sq - 2, FLAG_CASTLE))
         return possibles_moves
 
     def get_possibles_moves2(self):
         """
-        Get all the possibles moves for the current player.
+        Get all the possibles moves for the current player with the per-piece methods (square by square on the board).
         """
         possibles_moves = []
-        for row in range(8):
-            for col in range(8):
-                if self.board[row][col] != "--":
-                    possibles_moves += self.get_possibles_moves_for_a_piece(row, col, possibles_moves)
+        for square, piece in enumerate(self.mailbox):
+            if piece[0] == self.color:
+                self.get_possibles_moves_for_a_piece(square // 8, square % 8, possibles_moves)
+        if self.castle_rights:
+            self.get_castling_moves(possibles_moves)
         return possibles_moves
 
     def is_in_check(self):
         """
         Check if the current player is in check:
         """
-        if self.color == "w":
-            king_row = self.find_king("wK")[0]
-            king_col = self.find_king("wK")[1]
-        else:
-            king_row = self.find_king("wK")[0]
-            king_col = self.find_king("wK")[1]
-        for row in range(8):
-            for col in range(8):
-                if self.board[row][col][0] != self.color:
-                    valid_moves = self.get_possibles_moves_for_a_piece(row, col)
-                    for move in valid_moves:
-                        if move.end_row == king_row and move.end_col == king_col:
-                            return True
-        return False
+        if self._attack_info is not None and self._attack_info[0] == self.zobrist_hash:
+            return bool(self._attack_info[1].checkers)
+        return self.is_square_attacked(self.king_sq[self.color], OPPONENT[self.color])
+
+    def is_square_attacked(self, square, by_color):
+        """
+        Check if a square is attacked by a piece of the given color. We look from the square with each kind of piece
+        and see if we find such a piece of the attacking color (a knight on the square attacks the knights, etc.).
+        """
+        bitboards = self.bitboards
+        if PAWN_ATTACKS[OPPONENT[by_color]][square] & bitboards[by_color + "P"]:
+            return True
+        if KNIGHT_ATTACKS[square] & bitboards[by_color + "N"]:
+            return True
+        if KING_ATTACKS[square] & bitboards[by_color + "K"]:
+            return True
+        occupied = self.occupancy["w"] | self.occupancy["b"]
+        queens = bitboards[by_color + "Q"]
+        if sliding_attacks(square, occupied, BISHOP_RAYS) & (bitboards[by_color + "B"] | queens):
+            return True
+        return bool(sliding_attacks(square, occupied, ROOK_RAYS) & (bitboards[by_color + "R"] | queens))
 
     def find_king(self, color):
         """
         Find the row and column of the king of a given color.
         """
-        for row in range(8):
-            for col in range(8):
-                if self.board[row][col] == color + "K":
-                    return row, col
-        return Exception("No king found")
+        if not self.bitboards[color + "K"]:
+            raise Exception("No king found")
+        return SQUARES[self.king_sq[color]]
 
     def get_possibles_moves_for_a_piece(self, row, col, possibles_moves):
         """
         Get all the possibles moves for a piece at a given row and column.
         """
-        piece = self.board[row][col]
+        piece = self.mailbox[row * 8 + col]
         if piece[1] == "P":
-            possibles_moves += self.get_possibles_moves_for_pawn(row, col, possibles_moves)
+            self.get_possibles_moves_for_pawn(row, col, possibles_moves)
         elif piece[1] == "R":
-            possibles_moves += self.get_possibles_moves_for_rook(row, col, possibles_moves)
+            self.get_possibles_moves_for_rook(row, col, possibles_moves)
         elif piece[1] == "N":
-            possibles_moves += self.get_possibles_moves_for_knight(row, col, possibles_moves)
+            self.get_possibles_moves_for_knight(row, col, possibles_moves)
         elif piece[1] == "B":
-            possibles_moves += self.get_possibles_moves_for_bishop(row, col, possibles_moves)
+            self.get_possibles_moves_for_bishop(row, col, possibles_moves)
         elif piece[1] == "Q":
-            possibles_moves += self.get_possibles_moves_for_queen(row, col, possibles_moves)
+            self.get_possibles_moves_for_queen(row, col, possibles_moves)
         elif piece[1] == "K":
-            possibles_moves += self.get_possibles_moves_for_king(row, col, possibles_moves)
+            self.get_possibles_moves_for_king(row, col, possibles_moves)
         return possibles_moves
 
     def get_possibles_moves_for_a_piece2(self, row, col):
         """
         Get all the possibles moves for a piece at a given row and column.
         """
-        possibles_moves = []
-        piece = self.board[row][col]
-        if piece[1] == "P":
-            possibles_moves += self.get_possibles_moves_for_pawn(row, col, possibles_moves)
-        elif piece[1] == "R":
-            possibles_moves += self.get_possibles_moves_for_rook(row, col, possibles_moves)
-        elif piece[1] == "N":
-            possibles_moves += self.get_possibles_moves_for_knight(row, col, possibles_moves)
-        elif piece[1] == "B":
-            possibles_moves += self.get_possibles_moves_for_bishop(row, col, possibles_moves)
-        elif piece[1] == "Q":
-            possibles_moves += self.get_possibles_moves_for_queen(row, col, possibles_moves)
-        elif piece[1] == "K":
-            possibles_moves += self.get_possibles_moves_for_king(row, col, possibles_moves)
-        return possibles_moves
+        return self.get_possibles_moves_for_a_piece(row, col, [])
 
     def getPawnMoves(self, row, col, moves):
         """
@@ -177,58 +1017,62 @@ class GameState:
         """
         Get all the possibles moves for a pawn at a given row and column.
         """
-        #possibles_moves = []
-        if self.whiteToMove:
-            if self.board[row - 1][col] == "--":
-                possibles_moves.append(Move((row, col), (row - 1, col), self.board))
-                if row == 6 and self.board[row - 2][col] == "--":
-                    possibles_moves.append(Move((row, col), (row-2, col), self.board))
-            if row-1 >= 0 and col-1 >= 0 and self.board[row-1][col-1][0] == "b":
-                possibles_moves.append(Move((row, col), (row-1, col-1), self.board))
-            if row-1 >= 0 and col+1 < 8 and self.board[row - 1][col + 1][0] == "b":
-                possibles_moves.append(Move((row, col), (row - 1, col + 1), self.board))
+        mailbox = self.mailbox
+        start = row * 8 + col
+        color = mailbox[start][0]
+        them = OPPONENT[color]
+        promotion = row == (1 if color == "w" else 6)  # the next row is the last one
+        ends = []
+        for end in PAWN_PUSHES[color][start]:
+            if mailbox[end] != EMPTY:
+                break
+            ends.append(end)
+        for end in PAWN_CAPTURES[color][start]:
+            if mailbox[end][0] == them:
+                ends.append(end)
+            elif end == self.enpassant_sq:
+                possibles_moves.append(Move(start, end, FLAG_ENPASSANT))
+        for end in ends:
+            if promotion:
+                for flags in PROMOTION_FLAGS:
+                    possibles_moves.append(Move(start, end, flags))
+            else:
+                possibles_moves.append(Move(start, end))
+        return possibles_moves
 
-        else:
-            if self.board[row + 1][col] == "--":
-                possibles_moves.append(Move((row, col), (row + 1, col), self.board))
-                if row == 1 and self.board[row + 2][col] == "--":
-                    possibles_moves.append(Move((row, col), (row+2, col), self.board))
-            if row+1 < 8 and col+1 < 8 and self.board[row+1][col+1][0] == "b":
-                possibles_moves.append(Move((row, col), (row+1, col+1), self.board))
-            if row+1 < 8 and col-1 >= 0 and self.board[row + 1][col - 1][0] == "b":
-                possibles_moves.append(Move((row, col), (row + 1, col + 1), self.board))
+    def get_sliding_moves(self, start, ray_lists, possibles_moves):
+        """
+        Moves of a slider along each ray until the first piece (taken if it is an enemy one).
+        """
+        mailbox = self.mailbox
+        color = mailbox[start][0]
+        for ray in ray_lists:
+            for end in ray:
+                target = mailbox[end]
+                if target == EMPTY:
+                    possibles_moves.append(Move(start, end))
+                else:
+                    if target[0] != color:
+                        possibles_moves.append(Move(start, end))
+                    break
+        return possibles_moves
+
+    def get_leaper_moves(self, start, targets, possibles_moves):
+        """
+        Moves of a knight or a king to the target squares which are not occupied by a piece of its color.
+        """
+        mailbox = self.mailbox
+        color = mailbox[start][0]
+        for end in targets:
+            if mailbox[end][0] != color:
+                possibles_moves.append(Move(start, end))
         return possibles_moves
 
     def get_possibles_moves_for_rook(self, row, col, possibles_moves):
         """
         Get all the possibles moves for a rook at a given row and column.
         """
-        #prev_pos = self.board[row][col]
-        max_row_steps_up = 7 - row
-        max_col_steps_up = 7 - col
-        #max_row_steps_down = row
-        #max_col_steps_down = col
-        for i in range(1, max_row_steps_up + 1):
-            if self.board[row + i][col] == "--":
-                possibles_moves.append(Move((row, col), (row+i, col), self.board))
-            else:
-                break
-        for i in range(1, row + 1):
-            if self.board[row - i][col] == "--":
-                possibles_moves.append(Move((row, col), (row+i, col), self.board))
-            else:
-                break
-        for i in range(1, max_col_steps_up + 1):
-            if self.board[row][col + i] == "--":
-                possibles_moves.append(Move((row, col), (row, col+i), self.board))
-            else:
-                break
-        for i in range(1, col + 1):
-            if self.board[row][col - i] == "--":
-                possibles_moves.append(Move((row, col), (row, col+i), self.board))
-            else:
-                break
-        return possibles_moves
+        return self.get_sliding_moves(row * 8 + col, ROOK_RAY_LISTS[row * 8 + col], possibles_moves)
 
     def getRookMoves(self, row, col, moves):
         pass
@@ -237,42 +1081,7 @@ class GameState:
         """
         Get all the possibles moves for a knight at a given row and column.
         """
-        if self.board[row][col][0] == "w":
-            if (row - 3 >= 0 and col - 2 >= 0) and self.board[row-3][col-2][0] == ("b" or "-"):
-                possibles_moves.append(Move((row, col), (row-3, col-2), self.board))
-            if (row - 3 >= 0 and col + 2 < 8) and (self.board[row-3][col+2][0] == ("b" or "-")):
-                possibles_moves.append(Move((row, col), (row-3, col+2), self.board))
-            if (row - 2 >= 0 and col - 3 >= 0) and (self.board[row-2][col-3][0] == ("b" or "-")):
-                possibles_moves.append(Move((row, col), (row-2, col-3), self.board))
-            if (row - 2 >= 0 and col + 3 < 8) and (self.board[row-2][col+3][0] == ("b" or "-")):
-                possibles_moves.append(Move((row, col), (row-2, col+3), self.board))
-            if (row + 2 < 8 and col - 3 >= 0) and (self.board[row+2][col-3][0] == ("b" or "-")):
-                possibles_moves.append(Move((row, col), (row+2, col-3), self.board))
-            if (row + 2 < 8 and col + 3 < 8) and (self.board[row+2][col+3][0] == ("b" or "-")):
-                possibles_moves.append(Move((row, col), (row+2, col+3), self.board))
-            if (row + 3 < 8 and col - 2 >= 0) and (self.board[row+3][col-2][0] == ("b" or "-")):
-                possibles_moves.append(Move((row, col), (row+3, col-2), self.board))
-            if (row + 3 < 8 and col + 2 < 8) and (self.board[row+3][col+2][0] == ("b" or "-")):
-                possibles_moves.append(Move((row, col), (row+3, col+2), self.board))
-
-        if self.board[row][col][0] == "b":
-            if (row - 3 >= 0 and col - 2 >= 0) and self.board[row - 3][col - 2][0] == ("w" or "-"):
-                possibles_moves.append(Move((row, col), (row - 3, col - 2), self.board))
-            if (row - 3 >= 0 and col + 2 < 8) and (self.board[row - 3][col + 2][0] == ("w" or "-")):
-                possibles_moves.append(Move((row, col), (row - 3, col + 2), self.board))
-            if (row - 2 >= 0 and col - 3 >= 0) and (self.board[row - 2][col - 3][0] == ("w" or "-")):
-                possibles_moves.append(Move((row, col), (row - 2, col - 3), self.board))
-            if (row - 2 >= 0 and col + 3 < 8) and (self.board[row - 2][col + 3][0] == ("w" or "-")):
-                possibles_moves.append(Move((row, col), (row - 2, col + 3), self.board))
-            if (row + 2 < 8 and col - 3 >= 0) and (self.board[row + 2][col - 3][0] == ("w" or "-")):
-                possibles_moves.append(Move((row, col), (row + 2, col - 3), self.board))
-            if (row + 2 < 8 and col + 3 < 8) and (self.board[row + 2][col + 3][0] == ("w" or "-")):
-                possibles_moves.append(Move((row, col), (row + 2, col + 3), self.board))
-            if (row + 3 < 8 and col - 2 >= 0) and (self.board[row + 3][col - 2][0] == ("w" or "-")):
-                possibles_moves.append(Move((row, col), (row + 3, col - 2), self.board))
-            if (row + 3 < 8 and col + 2 < 8) and (self.board[row + 3][col + 2][0] == ("w" or "-")):
-                possibles_moves.append(Move((row, col), (row + 3, col + 2), self.board))
-            return possibles_moves
+        return self.get_leaper_moves(row * 8 + col, KNIGHT_TARGETS[row * 8 + col], possibles_moves)
 
     def getKnightMoves(self, row, col, moves):
         pass
@@ -281,30 +1090,7 @@ class GameState:
         """
         Get all the possibles moves for a bishop at a given row and column.
         """
-        max_row_steps_up = 7 - row
-        max_col_steps_up = 7 - col
-        for i in range(1, max_row_steps_up + 1):
-            if col + i < 8 and self.board[row + i][col + i] == "--":
-                possibles_moves.append(Move((row, col), (row+i, col+i), self.board))
-            else:
-                break
-        for i in range(1, max_row_steps_up + 1):
-            if col - i >= 0 and self.board[row + i][col - i] == "--":
-                possibles_moves.append(Move((row, col), (row+i, col-i), self.board))
-            else:
-                break
-        for i in range(1, row + 1):
-            if col + i < 8 and self.board[row - i][col + i] == "--":
-                possibles_moves.append(Move((row, col), (row-i, col+i), self.board))
-            else:
-                break
-        for i in range(1, row + 1):
-            if col - i < 8 and self.board[row - i][col - i] == "--":
-                possibles_moves.append(Move((row, col), (row-i, col-i), self.board))
-            else:
-                break
-
-        return possibles_moves
+        return self.get_sliding_moves(row * 8 + col, BISHOP_RAY_LISTS[row * 8 + col], possibles_moves)
 
     def getBishopMoves(self, row, col, moves):
         pass
@@ -313,54 +1099,23 @@ class GameState:
         """
         Get all the possibles moves for a queen at a given row and column.
         """
-        possibles_moves = self.get_possibles_moves_for_rook(row, col, possibles_moves) + self.get_possibles_moves_for_bishop(row, col, possibles_moves)
-        return possibles_moves
+        return self.get_sliding_moves(row * 8 + col, QUEEN_RAY_LISTS[row * 8 + col], possibles_moves)
 
     def getQueenMoves(self, row, col, moves):
         pass
 
     def get_possibles_moves_for_king(self, row, col, possibles_moves):
         """
-        Get all the possibles moves for a king at a given row and column.
-        """
-        if self.color == "w":
-            if row == 7 and col == 4:
-                if self.board[7][3] == "--" and self.board[7][2] == "--" and self.board[7][1] == "--" and self.board[7][0] == "wR":
-                    possibles_moves.append(Move((row, col), (7, 2), self.board))
-                if self.board[7][5] == "--" and self.board[7][6] == "--" and self.board[7][7] == "wR":
-                    possibles_moves.append(Move((row, col), (7, 6), self.board))
-        if self.color == "b":
-            if row == 0 and col == 4:
-                if self.board[0][3] == "--" and self.board[0][2] == "--" and self.board[0][1] == "--" and self.board[0][0] == "bR":
-                    possibles_moves.append(Move((row, col), (0, 2), self.board))
-                if self.board[0][5] == "--" and self.board[0][6] == "--" and self.board[0][7] == "bR":
-                    possibles_moves.append(Move((row, col), (0, 6), self.board))
-        # ↑ check if the king have space to castle (for now we don't check if the king has already moved) TODO: check if the king has already moved
-        if row - 1 >= 0:
-            if col - 1 >= 0 and : #TODO
-                possibles_moves.append(Move((row, col), (row - 1, col - 1), self.board))
-            if col + 1 < 8 and : #TODO
-                possibles_moves.append(Move((row, col), (row - 1, col + 1), self.board))
-            if self.board[row-1][col] == "--":
-                possibles_moves.append(Move((row, col), (row - 1, col), self.board))
-        if row + 1 < 8:
-            if col - 1 >= 0:
-                possibles_moves.append(Move((row, col), (row + 1, col - 1), self.board))
-            if col + 1 < 8:
-                possibles_moves.append(Move((row, col), (row + 1, col + 1), self.board))
-            possibles_moves.append(Move((row, col), (row + 1, col), self.board))
-        if col - 1 >= 0:
-            possibles_moves.append(Move((row, col), (row, col - 1), self.board))
-        if col + 1 < 8:
-            possibles_moves.append(Move((row, col), (row, col + 1), self.board))
-        return possibles_moves
+        Get all the possibles moves for a king at a given row and column (castling is added by get_castling_moves).
+        """
+        return self.get_leaper_moves(row * 8 + col, KING_TARGETS[row * 8 + col], possibles_moves)
 
     def getKingMoves(self, row, col, moves):
         pass
 
     def switch_turn(self):
         self.whiteToMove = not self.whiteToMove
-        self.color = "b" if self.whiteToMove else "w"
+        self.color = "w" if self.whiteToMove else "b"
 
     def undo_move(self):
         """
@@ -368,14 +1123,60 @@ class GameState:
         """
         if len(self.moveLog) > 0:
             move = self.moveLog.pop()
-            self.board[move.start_row][move.start_col] = move.piece_moved
-            self.board[move.end_row][move.end_col] = move.piece_captured
-            #TODO: undo IA suggestions (display the previous suggestions)
+            if self.halfmove_clock == 0:
+                self.position_counts = self.position_counts_log.pop()
+            elif self.position_counts[self.zobrist_hash] == 1:
+                del self.position_counts[self.zobrist_hash]
+            else:
+                self.position_counts[self.zobrist_hash] -= 1
+            (captured, self.castle_rights, self.enpassant_sq, self.halfmove_clock, self.zobrist_hash, self.psq,
+             self.phase) = self.stateLog.pop()
             GameState.switch_turn(self)
+            if not self.whiteToMove:
+                self.fullmove_number -= 1
+            bitboards = self.bitboards
+            mailbox = self.mailbox
+            occupancy = self.occupancy
+            us = self.color
+            them = OPPONENT[us]
+            move_id = move.moveID
+            start = move_id & 63
+            end = move_id >> 6 & 63
+            flags = move_id >> 12
+            piece = mailbox[end]
+            start_end = (1 << start) | (1 << end)
+            if flags & FLAG_PROMOTION:
+                bitboards[piece] ^= 1 << end
+                piece = us + "P"
+                bitboards[piece] |= 1 << end
+            elif piece[1] == "K":
+                self.king_sq[us] = start
+                if flags == FLAG_CASTLE:
+                    rook_start, rook_end = CASTLING_ROOKS[end]
+                    rook_bits = (1 << rook_start) | (1 << rook_end)
+                    bitboards[us + "R"] ^= rook_bits
+                    occupancy[us] ^= rook_bits
+                    mailbox[rook_start] = us + "R"
+                    mailbox[rook_end] = EMPTY
+            bitboards[piece] ^= start_end
+            occupancy[us] ^= start_end
+            mailbox[start] = piece
+            mailbox[end] = EMPTY
+            if flags == FLAG_ENPASSANT:
+                captured_sq = end + 8 if us == "w" else end - 8
+                bitboards[captured] ^= 1 << captured_sq
+                occupancy[them] ^= 1 << captured_sq
+                mailbox[captured_sq] = captured
+            elif captured != EMPTY:
+                bitboards[captured] ^= 1 << end
+                occupancy[them] ^= 1 << end
+                mailbox[end] = captured
+            self._board = None
+            #TODO: undo IA suggestions (display the previous suggestions)
 
 
 # 2 ways to visualize the pieces moves : chess notation method or "2 strings method" (I will specify later.)
-class Move:  # TODO: add in castling, en passant, pawn promotion and maybe check, checkmate, stalemate and draw.
+class Move:
     # maps key to values.
     # key : value
     ranks_to_row = {"1": 7, "2": 6, "3": 5, "4": 4, "5": 3, "6": 2, "7": 1, "8": 0} # i'm happy you understand this my friend Github Copilot :D
@@ -383,22 +1184,73 @@ class Move:  # TODO: add in castling, en passant, pawn promotion and maybe check
     files_to_col = {"a": 0, "b": 1, "c": 2, "d": 3, "e": 4, "f": 5, "g": 6, "h": 7}
     cols_to_file = {v: k for k, v in files_to_col.items()}
 
-    def __init__(self, start_sq, end_sq, board):
-        self.start_row = start_sq[0]
-        self.start_col = start_sq[1]
-        self.end_row = end_sq[0]
-        self.end_col = end_sq[1]
-        self.board = board
-        self.piece_moved = board[self.start_row][self.start_col]
-        self.piece_captured = board[self.end_row][self.end_col]
-        self.moveID = self.start_row * 1000 + self.start_col * 100 + self.end_row * 10 + self.end_col  # a unique ID for each move. (between 0 and 7777)
-        print(self.moveID, self.piece_moved)  # for debug purpose TODO: remove this line.
+    # A move is only its ID, a 16 bits int: start square (bits 0-5), end square (bits 6-11) and flags (bits 12-15).
+    # The generators make millions of them, so no board and no other attribute: the rest is computed when asked.
+    __slots__ = ("moveID",)
+
+    def __init__(self, start_sq, end_sq, flags=0):
+        self.moveID = start_sq | end_sq << 6 | flags << 12
+
+    @classmethod
+    def from_coords(cls, start_sq, end_sq, promotion=None):
+        """
+        Move from (row, col) tuples, as the UI gets them from the clicks.
+        """
+        flags = FLAG_PROMOTION | PROMOTION_PIECES.index(promotion) if promotion else 0
+        return cls(start_sq[0] * 8 + start_sq[1], end_sq[0] * 8 + end_sq[1], flags)
+
+    @property
+    def start_sq(self):
+        return self.moveID & 63
+
+    @property
+    def end_sq(self):
+        return self.moveID >> 6 & 63
+
+    @property
+    def flags(self):
+        return self.moveID >> 12
+
+    @property
+    def start_row(self):
+        return (self.moveID & 63) >> 3
+
+    @property
+    def start_col(self):
+        return self.moveID & 7
+
+    @property
+    def end_row(self):
+        return (self.moveID >> 6 & 63) >> 3
+
+    @property
+    def end_col(self):
+        return self.moveID >> 6 & 7
+
+    @property
+    def promotion(self):
+        flags = self.moveID >> 12
+        return PROMOTION_PIECES[flags & 3] if flags & FLAG_PROMOTION else None
+
+    @property
+    def is_enpassant(self):
+        return self.moveID >> 12 == FLAG_ENPASSANT
+
+    @property
+    def is_castle(self):
+        return self.moveID >> 12 == FLAG_CASTLE
 
     def __eq__(self, other):
         if isinstance(other, Move):
             return self.moveID == other.moveID
         return False
 
+    def __hash__(self):
+        return self.moveID
+
+    def __repr__(self):
+        return f"Move({self.get_chess_notation()})"
+
     def get_chess_notation(self):
         # TODO: make my own chess notation:
         #   - display the move number follow by a dot and a space (ex: "1. ")
@@ -418,16 +1270,110 @@ class Move:  # TODO: add in castling, en passant, pawn promotion and maybe check
         """return f"{turn}. {w_piece_moved}{w_start_sq}{w_castle}{w_eat_mark}{w_eaten}{w_check}->{w_end_sq}{w_promotion}" \
                f" {b_piece_moved}{b_start_sq}{b_castle}{b_eat_mark}{b_eaten}{w_check}->{b_end_sq}{b_promotion}" """
 
-        return self.get_rank_file(self.start_row, self.start_col) + self.get_rank_file(self.end_row, self.end_col)
+        promotion = self.promotion
+        return (self.get_rank_file(self.start_row, self.start_col) + self.get_rank_file(self.end_row, self.end_col)
+                + (promotion.lower() if promotion else ""))
 
     def get_rank_file(self, r, c):
         return self.cols_to_file[c] + self.rows_to_rank[r]
 
 
+class LRUCache:
+    """
+    Bounded cache, the least recently used entry dropped first, with hit/miss/eviction counters. get(key, make) gives
+    the entry of the key, made with make() (and kept) if it is not in the cache.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.entries = collections.OrderedDict()  # the most recently used last
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, make):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+        self.misses += 1
+        entry = make()
+        self.entries[key] = entry
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": self.size, "entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+# the legal moves of a position and its status, as kept by MoveCache (moves is a tuple: the entry is shared)
+MoveCacheEntry = collections.namedtuple("MoveCacheEntry", "moves in_check checkmate stalemate")
+
+
+class MoveCache(LRUCache):
+    """
+    Cache of the legal moves of the positions, by Zobrist hash. It is for the GUI and the analysis tools, which come
+    back to the same positions; the search doesn't use it (it sees millions of positions once, its transposition
+    table is what it needs).
+    """
+
+    def lookup(self, gs):
+        """
+        The MoveCacheEntry of the position, generated (and kept) if it is not in the cache.
+        """
+        def make_entry():
+            moves = tuple(gs.getValidMoves())
+            return MoveCacheEntry(moves, gs.is_in_check(), gs.checkmate, gs.stalemate)
+        return self.get(gs.zobrist_hash, make_entry)
+
+
+class PositionCache(LRUCache):
+    """
+    Cache of the positions already set up, by FEN string. The same positions come back again and again in analysis:
+    a hit costs a copy instead of parsing the FEN. Their moves come from a MoveCache (by default MOVE_CACHE).
+    """
+
+    def __init__(self, size=4096, move_cache=None):
+        super().__init__(size)
+        self.move_cache = move_cache
+
+    def lookup(self, fen):
+        """
+        (GameState, valid moves) of the FEN. The GameState and the list are new copies the caller can change.
+        """
+        key = " ".join(fen.split())
+        gs = self.get(key, lambda: GameState.from_fen(key)).copy()
+        return gs, gs.get_cached_valid_moves(self.move_cache)
+
+
+MOVE_CACHE = MoveCache()  # shared by the GUI, the PGN tools, the book...
+POSITION_CACHE = PositionCache()
+
+
+def get_position(fen):
+    """
+    (GameState, valid moves) of a FEN, from the shared POSITION_CACHE.
+    """
+    return POSITION_CACHE.lookup(fen)
+
+
 # TODO: Add in piece highlighting and move suggestions
 def highlight_piece(screen, gs, fromRow, fromCol):
     pass
 
-# TODO: Add in AI
-def get_ai_move(gs):
-    pass
\ No newline at end of file
+def get_ai_move(gs, depth=None, time_limit=None, use_book=True):
+    """
+    Best move for the player to move, see ChessAI.get_ai_move. (imported here so the engine doesn't need the AI)
+    """
+    import ChessAI
+    return ChessAI.get_ai_move(gs, depth=depth, time_limit=time_limit, use_book=use_book)
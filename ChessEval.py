@@ -0,0 +1,228 @@
+"""
+Static evaluation of a GameState: material and piece-square tables, in centipawns.
+evaluate_batch evaluates many positions at once with numpy (optional, only needed for it).
+
+usage:
+    python ChessEval.py         # benchmark: evaluate (incremental) against evaluate_full, in a search and on positions
+"""
+
+import argparse
+import collections
+import random
+import time
+
+import ChessEngine
+
+np = None  # numpy, imported by the batch evaluation the first time it is used (it takes longer than all the engine)
+
+
+# the values are kept in ChessEngine: GameState adds them up as the moves are made (see GameState.psq)
+PIECE_VALUES = ChessEngine.PIECE_VALUES
+PIECE_SQUARE_TABLES = ChessEngine.PIECE_SQUARE_TABLES
+ENDGAME_PIECE_SQUARE_TABLES = ChessEngine.ENDGAME_PIECE_SQUARE_TABLES
+
+
+def taper(psq, phase, white_to_move):
+    """
+    Score of packed material + piece-square values (white's point of view) for the phase, from the point of view of
+    the player to move: the middlegame value with all the pieces, sliding to the endgame value as they go.
+    """
+    mg = ((psq + 0x8000) & 0xFFFF) - 0x8000  # ChessEngine.unpack_score, inlined
+    eg = (psq - mg) >> 16
+    if phase > ChessEngine.PHASE_MAX:  # after promotions
+        phase = ChessEngine.PHASE_MAX
+    score = (mg * phase + eg * (ChessEngine.PHASE_MAX - phase)) // ChessEngine.PHASE_MAX
+    return score if white_to_move else -score
+
+
+def evaluate(gs):
+    """
+    Evaluation of the position in centipawns, from the point of view of the player to move: material and piece-square
+    tables tapered between the middlegame and the endgame. O(1): the sums are kept by make_move and undo_move.
+    """
+    psq = gs.psq
+    mg = ((psq + 0x8000) & 0xFFFF) - 0x8000  # taper, inlined: this is called at every leaf of the search
+    eg = (psq - mg) >> 16
+    phase = gs.phase if gs.phase < ChessEngine.PHASE_MAX else ChessEngine.PHASE_MAX
+    score = (mg * phase + eg * (ChessEngine.PHASE_MAX - phase)) // ChessEngine.PHASE_MAX
+    return score if gs.whiteToMove else -score
+
+
+def evaluate_full(gs):
+    """
+    Same as evaluate, but adding up the pieces of the board instead of using the sums kept by the GameState (to check
+    them, and to compare the speed: python ChessEval.py).
+    """
+    psq = phase = 0
+    for piece, bb in gs.bitboards.items():
+        values = ChessEngine.PSQ[piece]
+        while bb:
+            low = bb & -bb
+            psq += values[low.bit_length() - 1]
+            phase += ChessEngine.PIECE_PHASES[piece]
+            bb ^= low
+    return taper(psq, phase, gs.whiteToMove)
+
+
+# Batch evaluation: the positions are turned into planes (one 8*8 array of 0/1 per piece, in ChessEngine.PIECES
+# order) and all of them are scored together with numpy array operations instead of a python loop per position.
+MOBILITY_WEIGHT = 4  # centipawns per square a piece can go to
+
+BatchEvaluation = collections.namedtuple("BatchEvaluation", "planes material positional mobility score")
+
+_batch_tables = None
+
+
+def _get_batch_tables():
+    """
+    (material values, middlegame tables, endgame tables, phase weights) as numpy arrays of shape (12,), (12, 64),
+    (12, 64) and (12,), signed by color, from ChessEngine.PSQ: the values of evaluate.
+    """
+    global _batch_tables
+    if _batch_tables is None:
+        material = np.array([PIECE_VALUES[piece[1]] * (1 if piece[0] == "w" else -1) for piece in ChessEngine.PIECES],
+                            dtype=np.int32)
+        scores = np.array([[ChessEngine.unpack_score(score) for score in ChessEngine.PSQ[piece]]
+                           for piece in ChessEngine.PIECES], dtype=np.int32)  # (12, 64, 2): (mg, eg)
+        middlegame = scores[:, :, 0] - material[:, None]
+        endgame = scores[:, :, 1] - material[:, None]
+        phases = np.array([ChessEngine.PIECE_PHASES[piece] for piece in ChessEngine.PIECES], dtype=np.int32)
+        _batch_tables = (material, middlegame, endgame, phases)
+    return _batch_tables
+
+
+def to_planes(states):
+    """
+    (N, 12, 8, 8) uint8 array of the pieces of N GameStates: planes[n, piece index, row, col] is 1 if the piece is on
+    the square.
+    """
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("numpy is needed to evaluate positions in batch") from None
+        np = numpy
+    bitboards = np.array([[gs.bitboards[piece] for piece in ChessEngine.PIECES] for gs in states],
+                         dtype=np.uint64).reshape(-1, 12, 1)
+    bits = (bitboards >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+    return bits.astype(np.uint8).reshape(-1, 12, 8, 8)
+
+
+def _shift(planes, d_row, d_col):
+    """
+    Move everything on the (N, 8, 8) planes by (d_row, d_col), what goes off the board is lost.
+    """
+    shifted = np.zeros_like(planes)
+    shifted[:, max(d_row, 0):8 + min(d_row, 0), max(d_col, 0):8 + min(d_col, 0)] = \
+        planes[:, max(-d_row, 0):8 + min(-d_row, 0), max(-d_col, 0):8 + min(-d_col, 0)]
+    return shifted
+
+
+def mobility_batch(planes):
+    """
+    Number of squares the pieces (but the pawns) of white can go to, minus the same for black, for each position of
+    (N, 12, 8, 8) planes. Every piece is moved one step at a time in all its directions on all the boards at once.
+    """
+    boards = planes.astype(np.int16)
+    occupied = {"w": boards[:, :6].sum(axis=1), "b": boards[:, 6:].sum(axis=1)}
+    empty = 1 - occupied["w"] - occupied["b"]
+    mobility = np.zeros(len(boards), dtype=np.int32)
+    for color, first, sign in (("w", 0, 1), ("b", 6, -1)):
+        not_own = 1 - occupied[color]
+        knights, bishops, rooks, queens, king = (boards[:, first + index] for index in range(1, 6))
+        count = np.zeros(len(boards), dtype=np.int32)
+        for pieces, offsets in ((knights, ChessEngine.KNIGHT_OFFSETS), (king, ChessEngine.KING_OFFSETS)):
+            for d_row, d_col in offsets:
+                count += (_shift(pieces, d_row, d_col) * not_own).sum(axis=(1, 2))
+        for sliders, directions in ((rooks + queens, ChessEngine.ROOK_DIRECTIONS),
+                                    (bishops + queens, ChessEngine.BISHOP_DIRECTIONS)):
+            for d_row, d_col in directions:
+                frontier = sliders
+                for _ in range(7):
+                    frontier = _shift(frontier, d_row, d_col)
+                    count += (frontier * not_own).sum(axis=(1, 2))
+                    frontier = frontier * empty  # the sliders go on only through the empty squares
+                    if not frontier.any():
+                        break
+        mobility += sign * count
+    return mobility
+
+
+def evaluate_batch(states):
+    """
+    Evaluate N GameStates at once. Return a BatchEvaluation of arrays of shape (N,): material, positional (piece-square
+    tables, tapered by the phase like evaluate) and mobility (squares) from white's point of view, and score =
+    material + positional + MOBILITY_WEIGHT * mobility from the point of view of the player to move; with the
+    (N, 12, 8, 8) planes. material + positional is evaluate from white's point of view.
+    """
+    states = list(states)
+    planes = to_planes(states)
+    material_values, middlegame_values, endgame_values, phase_weights = _get_batch_tables()
+    pieces = planes.reshape(len(states), 12, 64).astype(np.int32)
+    counts = pieces.sum(axis=2)
+    material = counts @ material_values
+    phase = np.minimum(counts @ phase_weights, ChessEngine.PHASE_MAX)
+    middlegame = material + np.einsum("nps,ps->n", pieces, middlegame_values)
+    endgame = material + np.einsum("nps,ps->n", pieces, endgame_values)
+    positional = (middlegame * phase + endgame * (ChessEngine.PHASE_MAX - phase)) // ChessEngine.PHASE_MAX - material
+    mobility = mobility_batch(planes)
+    side = np.array([1 if gs.whiteToMove else -1 for gs in states], dtype=np.int32)
+    score = side * (material + positional + MOBILITY_WEIGHT * mobility)
+    return BatchEvaluation(planes, material, positional, mobility, score)
+
+
+def random_positions(count, seed=0):
+    """
+    Positions of random games (a few at each ply up to the middle of the endgame), for the benchmarks.
+    """
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < count:
+        gs = ChessEngine.GameState()
+        for _ in range(rng.randrange(20, 120)):
+            valid_moves = gs.getValidMoves()
+            if not valid_moves:
+                break
+            gs.make_move(rng.choice(valid_moves))
+            positions.append(gs.copy())
+    return positions[:count]
+
+
+def benchmark(position_count=20000, depth=4):
+    """
+    Compare evaluate (sums kept by make_move/undo_move) with evaluate_full (adding up the board): the time of one call,
+    then the time of the same searches with each of them (same scores, so the same tree).
+    """
+    import ChessAI
+    positions = random_positions(position_count)
+    mismatches = sum(evaluate(gs) != evaluate_full(gs) for gs in positions)
+    print(f"{len(positions)} positions, {mismatches} different evaluations")
+    for function in (evaluate, evaluate_full):
+        start = time.perf_counter()
+        for gs in positions:
+            function(gs)
+        print(f"{function.__name__:<14} {1e6 * (time.perf_counter() - start) / len(positions):6.2f} us/position")
+    fens = [ChessEngine.START_FEN, "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+            "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1"]
+    for fen in fens:
+        times = {}
+        for function in (evaluate, evaluate_full):
+            searcher = ChessAI.Searcher(evaluate=function)
+            start = time.perf_counter()
+            result = searcher.search(ChessEngine.GameState.from_fen(fen), depth=depth)
+            times[function] = time.perf_counter() - start
+        print(f"search depth {depth} ({result.nodes} nodes, score {result.score}): evaluate {times[evaluate]:.2f}s, "
+              f"evaluate_full {times[evaluate_full]:.2f}s ({times[evaluate_full] / times[evaluate]:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the incremental evaluation against the full one.")
+    parser.add_argument("--positions", type=int, default=20000)
+    parser.add_argument("--depth", type=int, default=4)
+    args = parser.parse_args()
+    benchmark(args.positions, args.depth)
+
+
+if __name__ == "__main__":
+    main()
@@ -29,9 +29,12 @@ The main driver file. it will be responsible for handling user input and display
 
 # TODO: Add in game over screen
 # TODO: Add in game reset
-# TODO: Add in game save and load
 
-import pygame as p
+import os
+import time
+
+import ChessAI
+import ChessArchive
 import ChessEngine
 # import memory ram data for shutdown the game if there is a memory leak:
 #import memomy_ram
@@ -41,42 +44,118 @@ WIDTH = HEIGHT = 512
 DIMENSION = 8
 SQ_SIZE = HEIGHT // DIMENSION
 MAX_FPS = 15 #for animations later on
-IMAGES = {}
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chess pieces", "Chess pieces package", "images")
+SPRITE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sprite_cache")  # scaled sprites by size
+# archive of the games saved with the 's' key, the 'l' key loads the last one
+SAVE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "savegames.cga")
+PLAYER_ONE = True  # white is played by a human (False: by the AI)
+PLAYER_TWO = False  # same for black
+AI_TIME_LIMIT = 2.0  # seconds the AI thinks for each move
 
 
-def load_images():
+# pygame is only imported when the window is opened (by load_pygame), so the tools importing this module don't need it
+# and don't pay for it.
+p = None
+
+
+def load_pygame():
+    """
+    Import pygame as the global p (once) and return it.
+    """
+    global p
+    if p is None:
+        import pygame
+        p = pygame
+    return p
+
+
+class SpriteCache(dict):
     """
-    initialize a global dict of images. This will be called exactly once in the main
+    The piece sprites scaled to the square size, loaded the first time each one is drawn (IMAGES['wP']...).
+    A scaled sprite is also saved as raw RGBA pixels in SPRITE_CACHE_DIR/<size>/, so the next launches read it back
+    instead of decoding and scaling the PNG. A cached sprite older than its PNG is made again.
     """
-    pieces = ['wP', 'wR', 'wN', 'wB', 'wK', 'wQ', 'bP', 'bR', 'bN', 'bB', 'bK', 'bQ']
-    for piece in pieces:
-        IMAGES[piece] = p.transform.scale(p.image.load("chess pieces/Chess pieces package/images/" + piece + ".png"), (SQ_SIZE, SQ_SIZE))
 
-    #Note: We can access an image by saying 'IMAGES['wp']'
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+
+    def resize(self, size):
+        """
+        Use another square size: the sprites are loaded again at the new size.
+        """
+        if size != self.size:
+            self.clear()
+            self.size = size
+
+    def __missing__(self, piece):
+        p = load_pygame()
+        png_path = os.path.join(IMAGES_DIR, piece + ".png")
+        cache_path = os.path.join(SPRITE_CACHE_DIR, str(self.size), piece + ".rgba")
+        size = (self.size, self.size)
+        try:
+            if os.path.getmtime(cache_path) >= os.path.getmtime(png_path):
+                with open(cache_path, "rb") as cache_file:
+                    sprite = p.image.frombytes(cache_file.read(), size, "RGBA")
+            else:
+                sprite = None
+        except (OSError, ValueError):  # not cached yet (or a bad file)
+            sprite = None
+        if sprite is None:
+            sprite = p.transform.scale(p.image.load(png_path), size)
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                with open(cache_path + ".tmp", "wb") as cache_file:
+                    cache_file.write(p.image.tobytes(sprite, "RGBA"))
+                os.replace(cache_path + ".tmp", cache_path)
+            except OSError:  # read-only directory: just no cache
+                pass
+        if p.display.get_surface() is not None:
+            sprite = sprite.convert_alpha()  # same pixel format as the screen: faster to blit
+        self[piece] = sprite
+        return sprite
+
+
+IMAGES = SpriteCache(SQ_SIZE)  # We can access an image by saying IMAGES['wP']
+
+
+def load_images():
+    """
+    Load all the sprites now instead of when they are first drawn.
+    """
+    for piece in ['wP', 'wR', 'wN', 'wB', 'wK', 'wQ', 'bP', 'bR', 'bN', 'bB', 'bK', 'bQ']:
+        IMAGES[piece]
 
 
 def main():
     """
     The main driver for our code. This will handle user input and updating the graphics
     """
+    load_pygame()
     p.init()
     screen = p.display.set_mode((WIDTH, HEIGHT))
     clock = p.time.Clock()
     screen.fill(p.Color("White"))
+    renderer = BoardRenderer(screen)
+    engine = ChessAI.EngineWorker()  # the AI thinks in another process, the window stays responsive
+    ai_thinking = False
+    game_over = None  # what ended the game
     gs = ChessEngine.GameState()
-    validMoves = gs.getValidMoves()
+    validMoves = gs.get_cached_valid_moves()
     moveMade = False  # flag to indicate if a move was made
-    load_images()  # only do this once, before the while loop
     running = True
     sq_selected = (None, None) # keep track of the last square the user clicked on. (row, col)
     player_clicks = []  # keep track of the player's clicks. (two tuples: [sq_(previously)_selected, sq_selected])
 
     while running:
+        human_turn = PLAYER_ONE if gs.whiteToMove else PLAYER_TWO
         for e in p.event.get():
             if e.type == p.QUIT:
                 running = False
+            elif e.type == p.VIDEOEXPOSE:  # the window was covered: what was on the screen is lost
+                renderer.invalidate()
             # mouse handler
-            elif e.type == p.MOUSEBUTTONDOWN:
+            elif e.type == p.MOUSEBUTTONDOWN and human_turn and not game_over:
                 # get the mouse position:
                 mouse_pos = p.mouse.get_pos()
                 # get the row and column of the mouse position:
@@ -93,41 +172,120 @@ def main():
                 # if it was the second click, check if the player clicked on a valid move:
                 # TODO: verify that the player clicked on a valid move
                 if len(player_clicks) == 2:
-                    move = ChessEngine.Move(player_clicks[0], player_clicks[1], gs.board)
+                    move = ChessEngine.Move.from_coords(player_clicks[0], player_clicks[1])
                     print(move.get_chess_notation())
-                    if move in validMoves:
-                        gs.make_move(move)
-                        moveMade = True
+                    for valid_move in validMoves:
+                        # same squares: the generated move knows about castling and en passant, and the
+                        # promotions are generated queen first.
+                        if (valid_move.moveID & 4095) == (move.moveID & 4095):
+                            gs.make_move(valid_move)
+                            moveMade = True
+                            break
                     sq_selected = (None, None)  # reset the selected square
                     player_clicks = []  # reset the player_clicks list
             # key handler
             elif e.type == p.KEYDOWN:
                 if e.key == p.K_z:
+                    engine.cancel()  # the AI was maybe thinking about the position we leave
+                    ai_thinking = False
                     gs.undo_move()
+                    if (PLAYER_ONE or PLAYER_TWO) and not (PLAYER_ONE if gs.whiteToMove else PLAYER_TWO):
+                        gs.undo_move()  # the AI had replied: take back the move of the human too, it is their turn
                     moveMade = True
                 if e.key == p.K_r:
                     resetGame(screen, gs)
                 if e.key == p.K_s:
                     saveGame(gs)
                 if e.key == p.K_l:
+                    engine.cancel()
+                    ai_thinking = False
                     loadGame(gs)
+                    moveMade = True
                 if e.key == p.K_q:
                     running = False
+        # the AI: start to think when it is its turn, then look at what it found without waiting for it
+        if not human_turn and not ai_thinking and not game_over and not moveMade:
+            engine.request(gs, time_limit=AI_TIME_LIMIT)
+            ai_thinking = True
+        for update in engine.poll():
+            result = update.result
+            if result.move is not None:
+                p.display.set_caption(f"AI depth {result.depth}: {result.move.get_chess_notation()} "
+                                      f"(score {result.score}, {result.nodes} nodes)")
+            if update.done:
+                ai_thinking = False
+                if result.move in validMoves:
+                    gs.make_move(result.move)
+                    moveMade = True
         if moveMade:
-            #validMoves = gs.getValidMoves()  # TODO: switch on
+            validMoves = gs.get_cached_valid_moves()
             moveMade = False
-        draw_game_state(screen, gs)
+            game_over = get_game_over_text(gs)
+            p.display.set_caption(game_over or "Chess")
+        draw_game_state(renderer, gs)
         clock.tick(MAX_FPS)
-        p.display.flip()
+    engine.close()
+
 
+def get_game_over_text(gs):
+    """
+    What ended the game ("checkmate: white wins", "draw: threefold repetition"...), or None if it goes on.
+    (gs.getValidMoves must have been called on the current position)
+    """
+    if gs.checkmate:
+        return "checkmate: " + ("black" if gs.whiteToMove else "white") + " wins"
+    if gs.stalemate:
+        return "draw: stalemate"
+    draw_reason = gs.get_draw_reason()
+    return "draw: " + draw_reason if draw_reason else None
 
-def draw_game_state(screen, gs):
+
+def draw_game_state(renderer, gs):
     """
-    Responsible for all the graphic with a current game state.
+    Responsible for all the graphic with a current game state. Only the squares which changed are drawn and sent to
+    the display, so nothing is done while the game is idle.
     """
-    draw_board(screen)  # draw squares on the board
     # add in piece highlighting or move suggestions (later)
-    draw_pieces(screen, gs.board)  # draw pieces on top of those squares
+    dirty_rects = renderer.draw(gs.mailbox)
+    if dirty_rects:
+        p.display.update(dirty_rects)
+
+
+class BoardRenderer:
+    """
+    Draw the position on the screen square by square. The empty board is rendered once on a surface, and we remember
+    the piece drawn on each square, so after a move only the 2 to 4 squares which changed are drawn again.
+    """
+    def __init__(self, screen):
+        load_pygame()
+        self.screen = screen
+        self.background = p.Surface((WIDTH, HEIGHT)).convert()
+        draw_board(self.background)
+        self.drawn = [None] * 64  # piece drawn on each square (None: not drawn yet)
+
+    def invalidate(self):
+        """
+        Draw the whole board again next time (ex: after the window was covered).
+        """
+        self.drawn = [None] * 64
+
+    def draw(self, squares):
+        """
+        Draw the squares of the list of 64 pieces (GameState.mailbox) which are not already on the screen. Return the
+        list of the rects drawn, to give to display.update.
+        """
+        dirty_rects = []
+        drawn = self.drawn
+        for square, piece in enumerate(squares):
+            if drawn[square] != piece:
+                row, col = divmod(square, DIMENSION)
+                rect = p.Rect(col * SQ_SIZE, row * SQ_SIZE, SQ_SIZE, SQ_SIZE)
+                self.screen.blit(self.background, rect, rect)
+                if piece != ChessEngine.EMPTY:
+                    self.screen.blit(IMAGES[piece], rect)
+                drawn[square] = piece
+                dirty_rects.append(rect)
+        return dirty_rects
 
 
 def draw_board(screen):
@@ -159,8 +317,10 @@ def draw_pieces(screen, board):
 
 # TODO: Add in move piece function
 def movePiece(gs, fromRow, fromCol, toRow, toCol):
-    gs.board[toRow][toCol] = gs.board[fromRow][fromCol]
-    gs.board[fromRow][fromCol] = "--"
+    board = [list(row) for row in gs.board]  # gs.board is a view of the bitboards, so we set a new one
+    board[toRow][toCol] = board[fromRow][fromCol]
+    board[fromRow][fromCol] = "--"
+    gs.board = board
     gs.whiteToMove = not gs.whiteToMove
     gs.moveLog.append((fromRow, fromCol, toRow, toCol))
     return gs
@@ -176,15 +336,35 @@ def getValidMoves(gs, fromRow, fromCol):
 def resetGame(screen, gs):
     NotImplemented
 
-# TODO: Add in game save and load
 def saveGame(gs):
-    NotImplemented
+    """
+    Append the game (all its moves, so they can still be undone after loading it) to the archive SAVE_FILE.
+    """
+    if gs.checkmate:
+        result = "0-1" if gs.whiteToMove else "1-0"
+    else:
+        result = "1/2-1/2" if gs.stalemate or gs.get_draw_reason() else "*"
+    headers = {"Event": "Casual game", "Date": time.strftime("%Y.%m.%d"),
+               "White": "Human" if PLAYER_ONE else "AI", "Black": "Human" if PLAYER_TWO else "AI"}
+    with ChessArchive.ArchiveWriter(SAVE_FILE) as archive:
+        number = archive.append_game_state(gs, headers, result)
+    print(f"game saved as number {number} in {SAVE_FILE}")
+
 
 def loadGame(gs):
-    NotImplemented
+    """
+    Load the last game saved in SAVE_FILE (if there is one) in the GameState.
+    """
+    try:
+        with ChessArchive.GameArchive(SAVE_FILE) as archive:
+            game = archive[-1]
+    except (FileNotFoundError, IndexError):
+        print("no saved game")
+        return
+    gs.set_fen(game.headers.get("FEN", ChessEngine.START_FEN))
+    for move_id in game.move_ids:
+        gs.make_move(next(move for move in gs.get_cached_valid_moves() if move.moveID == move_id))
 
 
 if __name__ == "__main__":
     main()
-
-
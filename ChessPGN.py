@@ -0,0 +1,265 @@
+"""
+Reading and writing PGN files (Portable Game Notation), and replaying their games with the engine.
+The files are read as a stream, one game at a time, so a file of any size is read in constant memory. The games can
+be replayed by a pool of worker processes (validation, statistics...).
+
+usage:
+    python ChessPGN.py games.pgn                # replay all the games and print statistics
+    python ChessPGN.py games.pgn --workers 8
+"""
+
+import argparse
+import collections
+import itertools
+import os
+import re
+import time
+
+import ChessEngine
+import ChessStats
+from ChessEngine import Move
+
+
+Game = collections.namedtuple("Game", "headers moves result")  # headers dict, moves in SAN, result ("1-0", "*"...)
+
+RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+SEVEN_TAG_ROSTER = ("Event", "Site", "Date", "Round", "White", "Black", "Result")  # the headers every game has
+# tokens of the movetext: comments, variations, NAGs ($n) and the moves themselves (with or without move numbers)
+TOKEN_PATTERN = re.compile(r"\{[^}]*\}|;[^\n]*|\$\d+|\(|\)|[^\s(){};]+")
+MOVE_NUMBER_PATTERN = re.compile(r"^\d+\.*")
+HEADER_PATTERN = re.compile(r'^\[(\w+)\s+"(.*)"\]$')
+# piece, start file, start rank, capture, end square, promotion (ex: "Nbd7", "exd5", "e8=Q", "R1xa3")
+SAN_PATTERN = re.compile(r"^([NBRQK])?([a-h])?([1-8])?(x)?([a-h][1-8])(?:=?([NBRQ]))?$")
+
+
+def read_games(pgn_file):
+    """
+    Yield the games of an open PGN file one by one, as Game(headers, moves, result). Comments, variations and NAGs
+    are skipped.
+    """
+    headers = {}
+    movetext = []
+    in_comment = False
+    for line in pgn_file:
+        line = line.strip()
+        if line.startswith("%") or (not line and not in_comment):
+            continue
+        if line.startswith("[") and not in_comment:
+            if movetext:  # a new game starts
+                yield _make_game(headers, movetext)
+                headers, movetext = {}, []
+            match = HEADER_PATTERN.match(line)
+            if match:
+                headers[match.group(1)] = match.group(2).replace('\\"', '"')
+            continue
+        movetext.append(line)
+        # a {comment} can go over several lines, and then a line of it could start with "["
+        for char in line:
+            if char == "{":
+                in_comment = True
+            elif char == "}":
+                in_comment = False
+            elif char == ";" and not in_comment:
+                break  # the rest of the line is a comment, its braces don't count
+    if movetext or headers:
+        yield _make_game(headers, movetext)
+
+
+def _make_game(headers, movetext):
+    moves = []
+    result = headers.get("Result", "*")
+    variation_depth = 0
+    for token in TOKEN_PATTERN.findall("\n".join(movetext)):
+        if token[0] in "{;$":
+            continue
+        if token == "(":
+            variation_depth += 1
+        elif token == ")":
+            variation_depth -= 1
+        elif variation_depth == 0:
+            if token in RESULTS:
+                result = token
+                continue
+            token = MOVE_NUMBER_PATTERN.sub("", token)  # "12." or "12..." or "12.e4"
+            if token:
+                moves.append(token)
+    return Game(headers, moves, result)
+
+
+def game_to_pgn(game, line_length=80):
+    """
+    PGN text of a Game (what read_games reads back): the headers, then the numbered moves wrapped to line_length
+    characters and the result, then an empty line.
+    """
+    headers = dict(game.headers)
+    headers["Result"] = game.result
+    tags = list(SEVEN_TAG_ROSTER) + [tag for tag in headers if tag not in SEVEN_TAG_ROSTER]
+    lines = []
+    for tag in tags:
+        value = str(headers.get(tag, "?")).replace("\\", "\\\\").replace('"', '\\"')
+        lines.append(f'[{tag} "{value}"]')
+    lines.append("")
+    # the move numbers start from the FEN position if the game doesn't start from the beginning
+    fen_fields = headers.get("FEN", ChessEngine.START_FEN).split()
+    black_to_move = fen_fields[1] == "b"
+    move_number = int(fen_fields[5]) if len(fen_fields) > 5 else 1
+    tokens = []
+    for index, san in enumerate(game.moves):
+        if not black_to_move:
+            tokens.append(f"{move_number}.")
+        elif index == 0:
+            tokens.append(f"{move_number}...")
+        tokens.append(san)
+        if black_to_move:
+            move_number += 1
+        black_to_move = not black_to_move
+    tokens.append(game.result)
+    line = ""
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > line_length:
+            lines.append(line)
+            line = token
+        else:
+            line = f"{line} {token}" if line else token
+    lines.append(line)
+    return "\n".join(lines) + "\n\n"
+
+
+def parse_san(gs, san):
+    """
+    The valid Move of the GameState written `san` in Standard Algebraic Notation (ex: "Nf3", "exd5", "O-O", "e8=Q+").
+    Raise a ValueError if the move is not valid or is ambiguous.
+    """
+    text = san.rstrip("+#!?")
+    if text in ("O-O", "0-0", "O-O-O", "0-0-0"):
+        king_sq = gs.king_sq[gs.color]
+        end = king_sq + 2 if len(text) == 3 else king_sq - 2
+        candidates = [move for move in gs.get_possibles_moves()
+                      if move.moveID >> 12 == ChessEngine.FLAG_CASTLE and move.moveID >> 6 & 63 == end]
+    else:
+        match = SAN_PATTERN.match(text)
+        if not match:
+            raise ValueError(f"invalid SAN move: {san!r}")
+        piece_name, start_file, start_rank, _, end_square, promotion = match.groups()
+        piece = gs.color + (piece_name or "P")
+        end = Move.ranks_to_row[end_square[1]] * 8 + Move.files_to_col[end_square[0]]
+        start_col = Move.files_to_col[start_file] if start_file else None
+        start_row = Move.ranks_to_row[start_rank] if start_rank else None
+        mailbox = gs.mailbox
+        candidates = []
+        for move in gs.get_possibles_moves():
+            move_id = move.moveID
+            start = move_id & 63
+            if (move_id >> 6 & 63 != end or mailbox[start] != piece or move.promotion != promotion
+                    or (start_col is not None and start % 8 != start_col)
+                    or (start_row is not None and start // 8 != start_row)):
+                continue
+            candidates.append(move)
+    legal_moves = [move for move in candidates if gs.is_legal(move)]
+    if len(legal_moves) != 1:
+        raise ValueError(f"{'ambiguous' if legal_moves else 'illegal'} move: {san!r} in {gs.to_fen()}")
+    return legal_moves[0]
+
+
+def to_san(gs, move, valid_moves=None):
+    """
+    Standard Algebraic Notation of a valid Move of the GameState (before the move is made).
+    """
+    if valid_moves is None:
+        valid_moves = gs.get_cached_valid_moves()
+    start, end = move.start_sq, move.end_sq
+    piece = gs.mailbox[start]
+    if move.is_castle:
+        san = "O-O" if end > start else "O-O-O"
+    else:
+        capture = gs.mailbox[end] != ChessEngine.EMPTY or move.is_enpassant
+        end_square = move.get_rank_file(move.end_row, move.end_col)
+        if piece[1] == "P":
+            san = (Move.cols_to_file[start % 8] + "x" if capture else "") + end_square
+            if move.promotion:
+                san += "=" + move.promotion
+        else:
+            # the other pieces of the same type which can go on the same square
+            others = [other.start_sq for other in valid_moves
+                      if other.end_sq == end and other.start_sq != start and gs.mailbox[other.start_sq] == piece]
+            disambiguation = ""
+            if others:
+                if all(other % 8 != start % 8 for other in others):
+                    disambiguation = Move.cols_to_file[start % 8]
+                elif all(other // 8 != start // 8 for other in others):
+                    disambiguation = Move.rows_to_rank[start // 8]
+                else:
+                    disambiguation = move.get_rank_file(move.start_row, move.start_col)
+            san = piece[1] + disambiguation + ("x" if capture else "") + end_square
+    gs.make_move(move)
+    if gs.is_in_check():
+        san += "#" if ChessEngine.MOVE_CACHE.lookup(gs).checkmate else "+"
+    gs.undo_move()
+    return san
+
+
+def replay_game(game):
+    """
+    Play the moves of a game on a GameState, and return its statistics: {"white", "black", "result", "plies",
+    "fen" (final position), "error" (None, or why a move couldn't be played)}.
+    """
+    gs = ChessEngine.GameState()
+    if "FEN" in game.headers:
+        gs.set_fen(game.headers["FEN"])
+    error = None
+    for san in game.moves:
+        try:
+            gs.make_move(parse_san(gs, san))
+        except ValueError as exception:
+            error = str(exception)
+            break
+    return {"white": game.headers.get("White", "?"), "black": game.headers.get("Black", "?"), "result": game.result,
+            "plies": len(gs.moveLog), "fen": gs.to_fen(), "error": error}
+
+
+def replay_games(games, function=replay_game, workers=None, batch_size=64):
+    """
+    Yield function(game) for each game, in order, computed by a pool of worker processes (in this process if
+    workers is 1). The games are read by batches so a huge file is never loaded at once.
+    """
+    workers = workers or os.cpu_count() or 1
+    games = iter(games)
+    if workers == 1:
+        yield from map(function, games)
+        return
+    with ChessStats.pool(workers) as pool:
+        while True:
+            batch = list(itertools.islice(games, batch_size * workers))
+            if not batch:
+                break
+            yield from ChessStats.imap(pool, function, batch, chunksize=batch_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay the games of a PGN file and print statistics.")
+    parser.add_argument("pgn_file")
+    parser.add_argument("--workers", type=int, default=0, help="number of worker processes (0: all the cores)")
+    parser.add_argument("--errors", action="store_true", help="print the games which couldn't be replayed")
+    ChessStats.add_arguments(parser)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    game_count = plies = error_count = 0
+    results = collections.Counter()
+    with open(args.pgn_file, encoding="utf-8", errors="replace") as pgn_file, ChessStats.session(args):
+        for stats in replay_games(read_games(pgn_file), workers=args.workers or None):
+            game_count += 1
+            plies += stats["plies"]
+            results[stats["result"]] += 1
+            if stats["error"]:
+                error_count += 1
+                if args.errors:
+                    print(f"game {game_count} ({stats['white']} - {stats['black']}): {stats['error']}")
+    elapsed = time.perf_counter() - start
+    print(f"{game_count} games, {plies} plies, {error_count} errors in {elapsed:.2f}s "
+          f"({game_count / max(elapsed, 1e-9):.1f} games/s, {plies / max(elapsed, 1e-9):.0f} plies/s)")
+    print("results: " + ", ".join(f"{result} {count}" for result, count in results.most_common()))
+
+
+if __name__ == "__main__":
+    main()
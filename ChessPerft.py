@@ -0,0 +1,159 @@
+"""
+Perft (performance test): count the leaf nodes of the move tree to a given depth and compare them with the known
+reference values. It is used to check the move generator is right and to measure how fast it is (nodes/second).
+
+usage:
+    python ChessPerft.py 4                      # the whole suite of test positions to depth 4 (or less if the
+                                                # reference values don't go that deep)
+    python ChessPerft.py 3 --fen "<fen>" --divide   # one position, with the node count of each root move
+    python ChessPerft.py 3 --generator legacy   # run with the per-piece methods instead of the bitboards
+"""
+
+import argparse
+import time
+
+import ChessEngine
+import ChessStats
+
+
+# (name, FEN, node counts at depth 1, 2, 3...)
+# reference values from https://www.chessprogramming.org/Perft_Results
+POSITIONS = [
+    ("start", "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+     [20, 400, 8902, 197281, 4865609, 119060324]),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+     [48, 2039, 97862, 4085603, 193690690]),
+    ("position 3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+     [14, 191, 2812, 43238, 674624, 11030083]),
+    ("position 4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+     [6, 264, 9467, 422333, 15833292]),
+    ("position 5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+     [44, 1486, 62379, 2103487, 89941194]),
+    ("position 6", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+     [46, 2079, 89890, 3894594, 164075551]),
+]
+
+
+def legacy_valid_moves(gs):
+    """
+    Legal moves from the per-piece methods (GameState.get_possibles_moves2), filtered by making each move.
+    """
+    us = gs.color
+    valid_moves = []
+    for move in gs.get_possibles_moves2():
+        gs.make_move(move)
+        if not gs.is_square_attacked(gs.king_sq[us], gs.color):
+            valid_moves.append(move)
+        gs.undo_move()
+    return valid_moves
+
+
+def bitboard_valid_moves(gs):
+    """
+    Legal moves from the bitboards (GameState.getValidMoves), looked up at each call so ChessStats can count them.
+    """
+    return gs.getValidMoves()
+
+
+GENERATORS = {
+    "bitboard": bitboard_valid_moves,
+    "legacy": legacy_valid_moves,
+}
+
+
+def perft(gs, depth, generator=bitboard_valid_moves):
+    """
+    Number of leaf nodes of the move tree of the given depth. The last level is only counted, not played.
+    """
+    moves = generator(gs)
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+    nodes = 0
+    for move in moves:
+        gs.make_move(move)
+        nodes += perft(gs, depth - 1, generator)
+        gs.undo_move()
+    return nodes
+
+
+def divide(gs, depth, generator=bitboard_valid_moves):
+    """
+    Perft split by root move: {move notation: leaf nodes below it}. Comparing it with another engine's divide
+    output shows which move has the wrong subtree.
+    """
+    counts = {}
+    for move in generator(gs):
+        gs.make_move(move)
+        counts[move.get_chess_notation()] = perft(gs, depth - 1, generator)
+        gs.undo_move()
+    return counts
+
+
+def run_position(name, fen, depth, expected=None, generator=bitboard_valid_moves, show_divide=False):
+    """
+    Perft of one position, printed on one line with the speed and the check against the reference value.
+    Return the node count and True if it is right (or if there is no reference value).
+    """
+    gs = ChessEngine.GameState.from_fen(fen)
+    start = time.perf_counter()
+    try:
+        if show_divide:
+            counts = divide(gs, depth, generator)
+            for notation in sorted(counts):
+                print(f"  {notation}: {counts[notation]}")
+            nodes = sum(counts.values())
+        else:
+            nodes = perft(gs, depth, generator)
+    except Exception as error:  # a broken generator can crash (ex: moves off the board), report it as a failure
+        print(f"{name:<12} depth {depth}  ERROR {type(error).__name__}: {error}")
+        return 0, False
+    elapsed = time.perf_counter() - start
+    reference = expected[depth - 1] if expected and depth <= len(expected) else None
+    if reference is None:
+        status = "--"
+    else:
+        status = "OK" if nodes == reference else f"FAIL (expected {reference})"
+    print(f"{name:<12} depth {depth}  nodes {nodes:>10}  {elapsed:8.3f}s  {nodes / max(elapsed, 1e-9):>10.0f} nodes/s  "
+          f"{status}")
+    return nodes, reference is None or nodes == reference
+
+
+def run_suite(depth, generator=bitboard_valid_moves, show_divide=False):
+    """
+    Perft of all the test positions, to the given depth or less when the reference values stop before.
+    """
+    ok = True
+    total_nodes = 0
+    start = time.perf_counter()
+    for name, fen, expected in POSITIONS:
+        position_depth = min(depth, len(expected))
+        nodes, position_ok = run_position(name, fen, position_depth, expected, generator, show_divide)
+        ok = ok and position_ok
+        total_nodes += nodes
+    elapsed = time.perf_counter() - start
+    print(f"total: {total_nodes} nodes in {elapsed:.3f}s ({total_nodes / max(elapsed, 1e-9):.0f} nodes/s), "
+          f"{'all OK' if ok else 'some FAILED'}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count the leaf nodes of the move tree (perft).")
+    parser.add_argument("depth", type=int, nargs="?", default=3)
+    parser.add_argument("--fen", help="position to test (default: all the test positions)")
+    parser.add_argument("--divide", action="store_true", help="show the node count of each root move")
+    parser.add_argument("--generator", choices=sorted(GENERATORS), default="bitboard")
+    ChessStats.add_arguments(parser)
+    args = parser.parse_args()
+
+    generator = GENERATORS[args.generator]
+    with ChessStats.session(args):
+        if args.fen:
+            expected = next((nodes for _, fen, nodes in POSITIONS if fen.split()[:4] == args.fen.split()[:4]), None)
+            _, ok = run_position("fen", args.fen, args.depth, expected, generator, args.divide)
+        else:
+            ok = run_suite(args.depth, generator, args.divide)
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Headless self-play: engine or random players play many games against each other with no window, in a pool of
+worker processes. The games are written as PGN as soon as they finish, and the speed (games/s) is reported, so it is
+also an end-to-end benchmark of the move generation and the search.
+
+usage:
+    python ChessSelfPlay.py 100                                  # 100 random vs random games
+    python ChessSelfPlay.py 20 --white engine --black engine --depth 2 --output games.pgn
+    python ChessSelfPlay.py 50 --white engine --time 0.1 --workers 4 --results results.jsonl
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import random
+import time
+
+import ChessAI
+import ChessEngine
+import ChessPGN
+import ChessStats
+
+
+PLAYERS = ("random", "engine")
+TT_SIZE = 1 << 18  # transposition table of the engine players, one per game
+DEFAULT_DEPTH = 2  # of the engine players when given neither a depth nor a time
+MAX_PLIES = 400  # a game still going on after this is stopped, with the result "*"
+
+
+def play_game(task):
+    """
+    Play one game. task: (game index, {"w": player, "b": player}, depth, time limit, max plies, random plies, seed).
+    The first `random plies` moves are random for both players so the engine games are not all the same.
+    Return {"index", "white", "black", "result", "termination", "plies", "nodes", "time", "pgn"}.
+    """
+    index, players, depth, time_limit, max_plies, random_plies, seed = task
+    rng = random.Random(seed)
+    searchers = {color: ChessAI.Searcher(ChessAI.TranspositionTable(TT_SIZE))
+                 for color in "wb" if players[color] == "engine"}
+    gs = ChessEngine.GameState()
+    sans = []
+    nodes = 0
+    start = time.perf_counter()
+    while True:
+        valid_moves = gs.get_cached_valid_moves()
+        draw_reason = gs.get_draw_reason()
+        if gs.checkmate:
+            result, termination = ("0-1" if gs.whiteToMove else "1-0"), "checkmate"
+        elif gs.stalemate:
+            result, termination = "1/2-1/2", "stalemate"
+        elif draw_reason:
+            result, termination = "1/2-1/2", draw_reason
+        elif len(sans) >= max_plies:
+            result, termination = "*", "max plies"
+        else:
+            if gs.color in searchers and len(sans) >= random_plies:
+                search = searchers[gs.color].search(gs, depth=depth, time_limit=time_limit)
+                nodes += search.nodes
+                move = search.move or rng.choice(valid_moves)
+            else:
+                move = rng.choice(valid_moves)
+            sans.append(ChessPGN.to_san(gs, move, valid_moves))
+            gs.make_move(move)
+            continue
+        break
+    elapsed = time.perf_counter() - start
+    names = {color: _player_name(players[color], depth, time_limit) for color in "wb"}
+    headers = {"Event": "Self-play", "Site": "?", "Date": datetime.date.today().strftime("%Y.%m.%d"),
+               "Round": str(index + 1), "White": names["w"], "Black": names["b"], "Termination": termination,
+               "PlyCount": str(len(sans)), "Nodes": str(nodes), "Time": f"{elapsed:.3f}"}
+    return {"index": index, "white": names["w"], "black": names["b"], "result": result, "termination": termination,
+            "plies": len(sans), "nodes": nodes, "time": elapsed,
+            "pgn": ChessPGN.game_to_pgn(ChessPGN.Game(headers, sans, result))}
+
+
+def _player_name(player, depth, time_limit):
+    if player != "engine":
+        return player
+    return f"engine (time {time_limit}s)" if time_limit is not None else f"engine (depth {depth})"
+
+
+def play_games(tasks, workers=None):
+    """
+    Yield the result of play_game for each task as soon as it is finished (not in order), played by a pool of worker
+    processes (in this process if workers is 1).
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        yield from map(play_game, tasks)
+        return
+    with ChessStats.pool(workers) as pool:
+        yield from ChessStats.imap(pool, play_game, tasks, ordered=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play games between engine or random players, with no window.")
+    parser.add_argument("games", type=int, nargs="?", default=10)
+    parser.add_argument("--white", choices=PLAYERS, default="random")
+    parser.add_argument("--black", choices=PLAYERS, default="random")
+    parser.add_argument("--depth", type=int, help=f"search depth of the engine (default: {DEFAULT_DEPTH})")
+    parser.add_argument("--time", type=float, help="time limit per move of the engine, in seconds")
+    parser.add_argument("--max-plies", type=int, default=MAX_PLIES)
+    parser.add_argument("--random-plies", type=int, default=4, help="random moves at the start of each game")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=0, help="number of worker processes (0: all the cores)")
+    parser.add_argument("--output", help="PGN file to write the games to")
+    parser.add_argument("--results", help="file to write the results to, one JSON object per line")
+    ChessStats.add_arguments(parser)
+    args = parser.parse_args()
+
+    depth = args.depth if args.depth is not None or args.time is not None else DEFAULT_DEPTH
+    players = {"w": args.white, "b": args.black}
+    tasks = [(index, players, depth, args.time, args.max_plies, args.random_plies, args.seed * 1000003 + index)
+             for index in range(args.games)]
+    pgn_file = open(args.output, "w", encoding="utf-8") if args.output else None
+    results_file = open(args.results, "w", encoding="utf-8") if args.results else None
+    start = time.perf_counter()
+    plies = nodes = 0
+    results = collections.Counter()
+    try:
+        with ChessStats.session(args):
+            for game in play_games(tasks, workers=args.workers or None):
+                plies += game["plies"]
+                nodes += game["nodes"]
+                results[game["result"]] += 1
+                print(f"game {game['index'] + 1}: {game['result']} ({game['termination']})  {game['plies']} plies  "
+                      f"{game['nodes']} nodes  {game['time']:.2f}s", flush=True)
+                if pgn_file:
+                    pgn_file.write(game["pgn"])
+                    pgn_file.flush()
+                if results_file:
+                    results_file.write(json.dumps({key: value for key, value in game.items() if key != "pgn"}) + "\n")
+                    results_file.flush()
+    finally:
+        for output_file in (pgn_file, results_file):
+            if output_file:
+                output_file.close()
+    elapsed = time.perf_counter() - start
+    games = sum(results.values())
+    print(f"{games} games, {plies} plies, {nodes} nodes in {elapsed:.2f}s ({games / max(elapsed, 1e-9):.2f} games/s, "
+          f"{plies / max(elapsed, 1e-9):.0f} plies/s, {nodes / max(elapsed, 1e-9):.0f} nodes/s)")
+    print("results: " + ", ".join(f"{result} {count}" for result, count in results.most_common()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""
+Analysis server: a long-running process which keeps engine worker processes warm (transposition tables, opening book,
+tablebases) and searches the positions sent by its clients over a TCP or Unix socket, so a request doesn't pay for
+starting python and importing the engine.
+
+The protocol is one JSON object per line in each direction:
+    {"id": 1, "fen": "<fen>", "depth": 6, "time": 1.0, "progress": true, "key": "game 12"}
+        -> {"id": 1, "type": "info", "move": "e2e4", "score": 30, "pv": ["e2e4", ...], "depth": 1, ...}  (each depth)
+        -> {"id": 1, "type": "bestmove", "move": "e2e4", "score": 35, "pv": [...], "depth": 6, ...}
+    {"id": 2, "cmd": "ping"}    -> {"id": 2, "type": "pong"}
+    {"id": 3, "cmd": "status"}  -> {"id": 3, "type": "status", "workers": 4, "pending": 2, "served": 120}
+    a bad request               -> {"id": ..., "type": "error", "error": "<message>"}
+The requests are sharded between the workers by their "key" (by default the position), so the same game or the same
+position always goes to the same worker and finds its transposition table warm. A connection can send several
+requests without waiting: the answers carry the "id" of their request.
+
+usage:
+    python ChessServer.py serve --workers 4                 # on 127.0.0.1:8765 (or --host, --port, --unix PATH)
+    python ChessServer.py analyse --fen "<fen>" --time 2    # a request from the command line
+"""
+
+import argparse
+import collections
+import contextlib
+import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+import zlib
+
+import ChessAI
+import ChessEngine
+import ChessStats
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+POLL_INTERVAL = 0.5  # seconds the dispatcher threads wait for an update before checking if the server is closed
+
+AnalysisResult = collections.namedtuple("AnalysisResult", "move score pv depth nodes time")  # moves as "e2e4"
+
+
+def _result_message(request_id, result, done):
+    return {"id": request_id, "type": "bestmove" if done else "info",
+            "move": result.move.get_chess_notation() if result.move else None, "score": result.score,
+            "pv": [move.get_chess_notation() for move in result.pv], "depth": result.depth, "nodes": result.nodes,
+            "time": round(result.time, 3)}
+
+
+def _analysis_result(answer):
+    return AnalysisResult(*(answer[field] for field in AnalysisResult._fields))
+
+
+def parse_position(fen):
+    """
+    GameState of the FEN of a request (a copy of the one kept by ChessEngine.POSITION_CACHE: the same positions come
+    back from the clients). Raise a ValueError if it is not a position the engine can search: one king of each color,
+    and the player who has just moved not in check.
+    """
+    if not isinstance(fen, str) or not fen.strip():
+        raise ValueError(f"invalid FEN: {fen!r}")
+    placement = fen.split()[0]
+    if placement.count("K") != 1 or placement.count("k") != 1:  # checked first: the cache generates the moves
+        raise ValueError(f"invalid FEN (each side needs one king): {fen!r}")
+    gs = ChessEngine.get_position(fen)[0]
+    if gs.is_square_attacked(gs.king_sq[ChessEngine.OPPONENT[gs.color]], gs.color):
+        raise ValueError(f"invalid FEN (the side not to move is in check): {fen!r}")
+    return gs
+
+
+class _ConnectionHandler(socketserver.StreamRequestHandler):
+    """
+    One client connection: read its requests line by line and give them to the AnalysisServer.
+    """
+
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()  # the answers are written by the dispatcher threads of the workers
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                message = json.loads(line)
+                if not isinstance(message, dict):
+                    raise ValueError("a request must be a JSON object")
+            except ValueError as error:
+                self.send({"id": None, "type": "error", "error": f"bad request: {error}"})
+                continue
+            self.server.analysis.handle_message(self, message)
+
+    def send(self, message):
+        data = (json.dumps(message) + "\n").encode()
+        with self.write_lock:
+            try:
+                self.wfile.write(data)
+            except OSError:  # the client is gone: the search goes on, its answer is dropped
+                pass
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class _UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+else:
+    _UnixServer = None
+
+
+class AnalysisServer:
+    """
+    The server: an address (a (host, port) tuple or the path of a Unix socket) and a pool of ChessAI.EngineWorker.
+    serve_forever() handles the connections until shutdown() (from another thread); close() stops the workers.
+    """
+
+    def __init__(self, address=(DEFAULT_HOST, DEFAULT_PORT), workers=None):
+        if isinstance(address, str):
+            if _UnixServer is None:
+                raise ValueError("Unix sockets are not supported on this system")
+            if os.path.exists(address):
+                if not stat.S_ISSOCK(os.stat(address).st_mode):
+                    raise ValueError(f"{address} exists and is not a socket")
+                os.remove(address)  # left by a server which didn't stop cleanly
+            server_class = _UnixServer
+        else:
+            server_class = _TCPServer
+        self.workers = [ChessAI.EngineWorker() for _ in range(workers or os.cpu_count() or 1)]
+        self.pending = {}  # (worker index, worker request id) -> (connection, client request id, progress)
+        self.served = 0
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.dispatchers = [threading.Thread(target=self._dispatch, args=(index,), daemon=True)
+                            for index in range(len(self.workers))]
+        for dispatcher in self.dispatchers:
+            dispatcher.start()
+        self.server = server_class(address, _ConnectionHandler)
+        self.server.analysis = self
+        self.address = self.server.server_address
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def close(self):
+        self.closed.set()
+        self.server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+        for worker in self.workers:
+            worker.close()
+        for dispatcher in self.dispatchers:
+            dispatcher.join()
+
+    def handle_message(self, connection, message):
+        request_id = message.get("id")
+        command = message.get("cmd", "analyse")
+        if command == "ping":
+            connection.send({"id": request_id, "type": "pong"})
+        elif command == "status":
+            with self.lock:
+                pending, served = len(self.pending), self.served
+            connection.send({"id": request_id, "type": "status", "workers": len(self.workers), "pending": pending,
+                             "served": served})
+        elif command == "analyse":
+            try:
+                self.start_analysis(connection, message)
+            except Exception as error:  # whatever is wrong in the request, the client gets an answer
+                connection.send({"id": request_id, "type": "error", "error": f"{type(error).__name__}: {error}"})
+        else:
+            connection.send({"id": request_id, "type": "error", "error": f"unknown command: {command!r}"})
+
+    def start_analysis(self, connection, message):
+        fen = message.get("fen") or ChessEngine.START_FEN
+        gs = parse_position(fen)
+        depth = message.get("depth")
+        time_limit = message.get("time")
+        if depth is not None:
+            depth = int(depth)
+        if time_limit is not None:
+            time_limit = float(time_limit)
+        ChessAI.max_search_depth(depth, time_limit)  # a depth below 1 or a time limit <= 0 would never stop
+        index = zlib.crc32(str(message.get("key") or " ".join(fen.split()[:4])).encode()) % len(self.workers)
+        with self.lock:  # registered before the dispatcher can see the first update
+            worker_request_id = self.workers[index].request(gs, depth, time_limit)
+            self.pending[index, worker_request_id] = (connection, message.get("id"), message.get("progress", True))
+
+    def _dispatch(self, index):
+        """
+        Thread sending the updates of a worker to the connections which asked for them.
+        """
+        worker = self.workers[index]
+        while not self.closed.is_set():
+            update = worker.wait(POLL_INTERVAL)
+            if update is None:
+                continue
+            with self.lock:
+                if update.done:
+                    target = self.pending.pop((index, update.request_id), None)
+                    self.served += 1
+                else:
+                    target = self.pending.get((index, update.request_id))
+            if target is None:
+                continue
+            connection, request_id, progress = target
+            if update.done or progress:
+                connection.send(_result_message(request_id, update.result, update.done))
+
+
+class _ClientConnection:
+    def __init__(self, address, timeout=None):
+        if isinstance(address, str):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.settimeout(timeout)
+            self.socket.connect(address)
+        else:
+            self.socket = socket.create_connection(address, timeout=timeout)
+        self.reader = self.socket.makefile("rb")
+        self.request_id = 0
+
+    def send(self, message):
+        self.request_id += 1
+        self.socket.sendall((json.dumps(dict(message, id=self.request_id)) + "\n").encode())
+        return self.request_id
+
+    def receive(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("the analysis server closed the connection")
+        return json.loads(line)
+
+    def close(self):
+        self.reader.close()
+        self.socket.close()
+
+
+class AnalysisClient:
+    """
+    Client of an AnalysisServer keeping up to pool_size connections open to reuse them, so it can be used by several
+    threads at once (each request takes a connection of the pool for its duration).
+    """
+
+    def __init__(self, address=(DEFAULT_HOST, DEFAULT_PORT), pool_size=4, timeout=None):
+        self.address = address
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()  # the open connections not in use, the last used first
+        self.slots = threading.BoundedSemaphore(pool_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        A connection of the pool (a new one if none is idle), given back at the end of the with block, or closed if
+        the block failed since the server may still be sending answers on it.
+        """
+        with self.slots:
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                connection = _ClientConnection(self.address, self.timeout)
+            try:
+                yield connection
+            except BaseException:
+                connection.close()
+                raise
+            self.idle.put(connection)
+
+    def _request(self, message, on_info=None):
+        """
+        Send a request and return its final answer, calling on_info(answer) on the progress answers before it.
+        """
+        with self.connection() as connection:
+            request_id = connection.send(message)
+            while True:
+                answer = connection.receive()
+                if answer.get("id") != request_id:
+                    continue
+                if answer["type"] != "info":
+                    return answer
+                if on_info is not None:
+                    on_info(answer)
+
+    def ping(self):
+        return self._request({"cmd": "ping"})["type"] == "pong"
+
+    def status(self):
+        return self._request({"cmd": "status"})
+
+    def analyse(self, fen=None, depth=None, time_limit=None, key=None, on_progress=None):
+        """
+        Search a position (the starting position if no FEN) and return an AnalysisResult.
+        on_progress(AnalysisResult) is called after each depth. key: the shard key (ex: an id of the game).
+        """
+        message = {"fen": fen, "depth": depth, "time": time_limit, "key": key, "progress": on_progress is not None}
+
+        def on_info(answer):
+            on_progress(_analysis_result(answer))
+
+        answer = self._request({name: value for name, value in message.items() if value is not None},
+                               on_info if on_progress is not None else None)
+        if answer["type"] == "error":
+            raise ValueError(answer["error"])
+        return _analysis_result(answer)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def print_progress(result):
+    print(f"depth {result.depth}  score {result.score}  pv {' '.join(result.pv)}  {result.nodes} nodes", flush=True)
+
+
+def _address(args):
+    return args.unix if args.unix else (args.host, args.port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analysis server searching positions for its clients.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--unix", metavar="PATH", help="listen on (or connect to) a Unix socket instead of TCP")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="run the server")
+    serve_parser.add_argument("--workers", type=int, default=0, help="number of worker processes (0: all the cores)")
+    analyse_parser = subparsers.add_parser("analyse", help="send a position to a running server")
+    analyse_parser.add_argument("--fen", help="position to search (default: the starting position)")
+    analyse_parser.add_argument("--depth", type=int)
+    analyse_parser.add_argument("--time", type=float, help="time limit in seconds")
+    ChessStats.add_arguments(parser)
+    args = parser.parse_args()
+
+    with ChessStats.session(args):
+        if args.command == "serve":
+            with AnalysisServer(_address(args), args.workers or None) as server:
+                print(f"{len(server.workers)} workers listening on {server.address}", flush=True)
+                try:
+                    server.serve_forever()
+                except KeyboardInterrupt:
+                    pass
+            return
+        with AnalysisClient(_address(args), pool_size=1) as client:
+            result = client.analyse(args.fen, args.depth, args.time, on_progress=print_progress)
+    print(f"best move {result.move}  score {result.score}  depth {result.depth}  {result.nodes} nodes  "
+          f"{result.time:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
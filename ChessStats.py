@@ -0,0 +1,309 @@
+"""
+Instrumentation of the engine: counters (moves made and unmade, move generations, check tests, search nodes,
+transposition table probes, hits and cutoffs...) and the time spent in each phase (move generation, evaluation,
+search). It is off by default: enable() replaces the hot functions with counting wrappers and disable() puts the
+originals back, so when it is off the engine runs its own code and costs nothing more.
+The counters are per process: the pools of workers are made with pool() and their tasks given with imap(), so the
+workers count too when the main process does and send their counters back with their results, to be added to its
+totals (merge()).
+
+The entry points (ChessPerft.py, ChessAI.py, ChessSelfPlay.py...) take the options added by add_arguments:
+    --stats [FILE]          count and print the counters as JSON at the end (or write them to FILE)
+    --stats-interval 1.0    also print a line with the counters every second
+    --profile [FILE]        run under cProfile and print the slowest functions (or write the profile to FILE)
+"""
+
+import collections
+import contextlib
+import functools
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+
+counters = collections.Counter()
+timings = collections.Counter()  # seconds spent in each phase (a phase can be inside another one)
+_originals = []  # (owner, name, original function) of the functions replaced by enable()
+_start_time = None
+_elapsed = 0.0
+
+
+def _counted(function, counter):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        counters[counter] += 1
+        return function(*args, **kwargs)
+    return wrapper
+
+
+def _timed(function, counter, phase):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        counters[counter] += 1
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings[phase] += time.perf_counter() - start
+    return wrapper
+
+
+def _tt_probe(function):
+    @functools.wraps(function)
+    def wrapper(self, key):
+        entry = function(self, key)
+        counters["tt_probes"] += 1
+        if entry is not None:
+            counters["tt_hits"] += 1
+        return entry
+    return wrapper
+
+
+def _tt_store(function):
+    lower_bound = sys.modules[function.__module__].LOWER_BOUND
+
+    @functools.wraps(function)
+    def wrapper(self, key, depth, score, flag, move_id):
+        counters["tt_stores"] += 1
+        if flag == lower_bound:
+            counters["beta_cutoffs"] += 1  # a node stored as a lower bound failed high
+        return function(self, key, depth, score, flag, move_id)
+    return wrapper
+
+
+def _modules(name):
+    """
+    The module `name`, and also __main__ if it is the same file run as a script (python ChessAI.py): its classes are
+    not the ones of the imported module.
+    """
+    modules = [__import__(name)]
+    main = sys.modules.get("__main__")
+    if os.path.splitext(os.path.basename(getattr(main, "__file__", None) or ""))[0] == name:
+        modules.append(main)
+    return modules
+
+
+def _hooks():
+    """
+    (owner, name, function -> wrapper) of the instrumented functions.
+    """
+    hooks = []
+    for engine in _modules("ChessEngine"):
+        hooks += [
+            (engine.GameState, "make_move", lambda function: _counted(function, "moves_made")),
+            (engine.GameState, "undo_move", lambda function: _counted(function, "moves_unmade")),
+            (engine.GameState, "get_possibles_moves", lambda function: _timed(function, "movegen_calls", "movegen")),
+            (engine.GameState, "getValidMoves",
+             lambda function: _timed(function, "legal_movegen_calls", "legal_movegen")),
+            (engine.GameState, "is_in_check", lambda function: _counted(function, "check_tests")),
+            (engine.GameState, "is_square_attacked", lambda function: _counted(function, "attack_tests")),
+            (engine.GameState, "get_attack_info", lambda function: _counted(function, "attack_info_calls")),
+        ]
+    for ai in _modules("ChessAI"):
+        hooks += [
+            (ai.TranspositionTable, "probe", _tt_probe),
+            (ai.TranspositionTable, "store", _tt_store),
+            (ai.Searcher, "negamax", lambda function: _counted(function, "nodes")),
+            (ai.Searcher, "quiescence", lambda function: _counted(function, "quiescence_nodes")),
+            (ai.Searcher, "search", lambda function: _timed(function, "searches", "search")),
+        ]
+    for evaluation in _modules("ChessEval"):
+        hooks.append((evaluation, "evaluate", lambda function: _timed(function, "evaluations", "evaluate")))
+    return hooks
+
+
+def is_enabled():
+    return bool(_originals)
+
+
+def enable():
+    """
+    Start counting. (the Searchers made before keep the evaluation function they were given: make them after this)
+    """
+    global _start_time
+    if _originals:
+        return
+    for owner, name, make_wrapper in _hooks():
+        function = getattr(owner, name)
+        _originals.append((owner, name, function))
+        setattr(owner, name, make_wrapper(function))
+    _start_time = time.perf_counter()
+
+
+def disable():
+    """
+    Stop counting and put the original functions back. The counters are kept until reset().
+    """
+    global _start_time, _elapsed
+    while _originals:
+        owner, name, function = _originals.pop()
+        setattr(owner, name, function)
+    if _start_time is not None:
+        _elapsed += time.perf_counter() - _start_time
+        _start_time = None
+
+
+def reset():
+    global _elapsed, _start_time
+    counters.clear()
+    timings.clear()
+    _elapsed = 0.0
+    if _start_time is not None:
+        _start_time = time.perf_counter()
+
+
+def snapshot():
+    """
+    {"elapsed": seconds counted, "counters": {...}, "timings": {phase: seconds}} of everything counted so far.
+    """
+    elapsed = _elapsed + (time.perf_counter() - _start_time if _start_time is not None else 0.0)
+    return {"elapsed": round(elapsed, 6), "counters": dict(counters),
+            "timings": {phase: round(seconds, 6) for phase, seconds in timings.items()}}
+
+
+def to_json(indent=2):
+    return json.dumps(snapshot(), indent=indent, sort_keys=True)
+
+
+def log_line():
+    """
+    One line with the counters and their rate per second, for the periodic log.
+    """
+    stats = snapshot()
+    elapsed = max(stats["elapsed"], 1e-9)
+    parts = [f"{name} {count} ({count / elapsed:.0f}/s)" for name, count in sorted(stats["counters"].items())]
+    if stats["counters"].get("tt_probes"):
+        parts.append(f"tt hit rate {stats['counters'].get('tt_hits', 0) / stats['counters']['tt_probes']:.1%}")
+    return f"[{stats['elapsed']:.1f}s] " + ", ".join(parts)
+
+
+def start_worker():
+    """
+    Count in a worker process, from zero (a forked process starts with the counters of its parent).
+    """
+    enable()
+    reset()
+
+
+def take():
+    """
+    snapshot() of the counters, then reset them: what a worker process sends back to the main one.
+    """
+    stats = snapshot()
+    reset()
+    return stats
+
+
+def merge(stats):
+    """
+    Add the counters and timings of a snapshot (of a worker process) to the ones of this process.
+    """
+    counters.update(stats["counters"])
+    timings.update(stats["timings"])
+
+
+def _init_pool_worker(count, initializer, initargs):
+    if count:
+        start_worker()  # first, so what the initializer makes (ex: a Searcher) uses the counting functions
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def pool(processes=None, initializer=None, initargs=()):
+    """
+    multiprocessing.Pool whose workers count when this process counts (their counters come back through imap).
+    """
+    return multiprocessing.Pool(processes, initializer=_init_pool_worker,
+                                initargs=(is_enabled(), initializer, initargs))
+
+
+def _counted_task(task):
+    function, argument = task
+    return function(argument), take()
+
+
+def imap(worker_pool, function, tasks, chunksize=1, ordered=True):
+    """
+    worker_pool.imap(function, tasks) (imap_unordered if not ordered) for a pool made by pool(): when this process
+    counts, the counters of the workers for each task are added to its own.
+    """
+    method = worker_pool.imap if ordered else worker_pool.imap_unordered
+    if not is_enabled():
+        yield from method(function, tasks, chunksize)
+        return
+    for result, stats in method(_counted_task, ((function, task) for task in tasks), chunksize):
+        merge(stats)
+        yield result
+
+
+class PeriodicLogger:
+    """
+    Print log_line() every `interval` seconds from a background thread, until stop().
+    """
+
+    def __init__(self, interval=1.0, output=sys.stderr):
+        self.interval = interval
+        self.output = output
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            print(log_line(), file=self.output, flush=True)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def add_arguments(parser):
+    """
+    Add the --stats, --stats-interval and --profile options to the argparse parser of an entry point.
+    """
+    parser.add_argument("--stats", nargs="?", const="-", metavar="FILE",
+                        help="count the engine operations and print them as JSON at the end (or write them to FILE)")
+    parser.add_argument("--stats-interval", type=float, metavar="SECONDS",
+                        help="with --stats, also print the counters every SECONDS")
+    parser.add_argument("--profile", nargs="?", const="-", metavar="FILE",
+                        help="run under cProfile and print the slowest functions (or write the profile to FILE)")
+
+
+@contextlib.contextmanager
+def session(args):
+    """
+    Run the body of an entry point with the instrumentation asked for by the options of add_arguments.
+    """
+    logger = None
+    profiler = None
+    if args.stats:
+        reset()
+        enable()
+        if args.stats_interval:
+            logger = PeriodicLogger(args.stats_interval)
+    if args.profile:
+        import cProfile  # not imported with the module, most runs don't profile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            if args.profile == "-":
+                import pstats
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(30)
+            else:
+                profiler.dump_stats(args.profile)
+        if logger is not None:
+            logger.stop()
+        if args.stats:
+            disable()
+            if args.stats == "-":
+                print(to_json(), file=sys.stderr)
+            else:
+                with open(args.stats, "w") as stats_file:
+                    stats_file.write(to_json() + "\n")
@@ -0,0 +1,392 @@
+"""
+Endgame tablebases: the exact result of every position of a small material (KQvK, KRvK, KPvK, KBNvK...) with the
+distance to mate, computed once by retrograde analysis and then read in O(1) by the search.
+
+A table is named by its material, white pieces then black pieces (ex: "KRvK", "KQvKR"). Its file holds one byte per
+index: the side to move, then the square of each piece in the order of the name. The byte is 0 for a draw (or an
+impossible position), n for a win in n plies and 128 + n for a loss in n plies (0: checkmated), for the player to
+move. The positions with castling rights or an en passant capture are not in the tables.
+The files are memory-mapped and only the pages probed are read.
+
+usage:
+    python ChessTablebase.py build KQvK KRvK KPvK          # the smaller tables they need are built first
+    python ChessTablebase.py probe --fen "8/8/8/4k3/8/8/8/4K2R w - - 0 1"
+"""
+
+import argparse
+import collections
+import itertools
+import mmap
+import os
+import time
+
+import ChessEngine
+import ChessStats
+from ChessEngine import EMPTY, OPPONENT
+
+
+TABLEBASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tablebases")
+EXTENSION = ".ctb"
+MAGIC = b"CTB1"
+HEADER_SIZE = 16  # magic, then the name of the table padded with spaces
+PIECE_ORDER = "KQRBNP"
+PROMOTION_PIECES = "QRBN"
+WIN, DRAW, LOSS = 1, 0, -1
+MAX_PLIES = 127
+# flags of the positions of a table being built: a capture or a promotion which draws, or which wins
+DRAW_EXIT = 1
+WIN_EXIT = 2
+
+
+def material_name(pieces):
+    """
+    Name of the table of a list of pieces (ex: ["wK", "bK", "wR"] -> "KRvK").
+    """
+    names = {"w": [], "b": []}
+    for piece in pieces:
+        names[piece[0]].append(piece[1])
+    return "v".join("".join(sorted(names[color], key=PIECE_ORDER.index)) for color in "wb")
+
+
+def flip_name(name):
+    """
+    Name of the same material with the colors swapped (ex: "KRvK" -> "KvKR").
+    """
+    white, black = name.split("v")
+    return black + "v" + white
+
+
+def table_pieces(name):
+    """
+    Pieces of a table in the order of its index (ex: "KRvK" -> ["wK", "wR", "bK"]). Raise a ValueError if the name
+    is not a valid material.
+    """
+    sides = name.split("v")
+    if (len(sides) != 2 or any(side.count("K") != 1 for side in sides)
+            or any(char not in PIECE_ORDER for side in sides for char in side)):
+        raise ValueError(f"invalid tablebase name: {name!r}")
+    return ["w" + char for char in sorted(sides[0], key=PIECE_ORDER.index)] + \
+           ["b" + char for char in sorted(sides[1], key=PIECE_ORDER.index)]
+
+
+def encode(wdl, plies):
+    if wdl == DRAW:
+        return 0
+    if plies > MAX_PLIES:
+        raise ValueError(f"distance to mate too long for the table: {plies} plies")
+    return plies if wdl == WIN else 128 + plies
+
+
+def decode(value):
+    """
+    (WIN, DRAW or LOSS, plies to mate) of a byte of a table, for the player to move.
+    """
+    if value == 0:
+        return DRAW, 0
+    return (WIN, value) if value < 128 else (LOSS, value - 128)
+
+
+class Tablebase:
+    """
+    One table file, memory-mapped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:4] != MAGIC:
+            self.close()
+            raise ValueError(f"not a tablebase file: {path}")
+        self.name = self.data[4:HEADER_SIZE].decode("ascii").strip()
+        self.pieces = table_pieces(self.name)
+        count = len(self.pieces)
+        self.weights = [64 ** (count - 1 - slot) for slot in range(count)]
+        self.half = 64 ** count  # the positions with black to move come after the ones with white to move
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def value(self, squares, white_to_move):
+        """
+        (WIN, DRAW or LOSS, plies to mate) for the player to move, the squares in the order of the table's pieces.
+        """
+        index = 0 if white_to_move else self.half
+        for square, weight in zip(squares, self.weights):
+            index += square * weight
+        return decode(self.data[HEADER_SIZE + index])
+
+    def probe_pieces(self, pieces, white_to_move):
+        """
+        Value of a position given as (piece, square) pairs of the material of the table.
+        """
+        squares_by_piece = collections.defaultdict(list)
+        for piece, square in pieces:
+            squares_by_piece[piece].append(square)
+        return self.value([squares_by_piece[piece].pop() for piece in self.pieces], white_to_move)
+
+
+class Tablebases:
+    """
+    The tables of a directory, opened when first needed and kept open (the least recently used are closed when
+    there are more than max_open).
+    """
+
+    def __init__(self, directory=TABLEBASE_DIR, max_open=64):
+        self.directory = directory
+        self.max_open = max_open
+        self.tables = collections.OrderedDict()  # name -> Tablebase, or None if there is no such file
+        names = [file_name[:-len(EXTENSION)] for file_name in
+                 (os.listdir(directory) if os.path.isdir(directory) else []) if file_name.endswith(EXTENSION)]
+        self.max_pieces = max((len(table_pieces(name)) for name in names), default=2)
+
+    def close(self):
+        for table in self.tables.values():
+            if table is not None:
+                table.close()
+        self.tables.clear()
+
+    def get_table(self, name):
+        if name in self.tables:
+            self.tables.move_to_end(name)
+            return self.tables[name]
+        path = os.path.join(self.directory, name + EXTENSION)
+        table = Tablebase(path) if os.path.exists(path) else None
+        self.tables[name] = table
+        if len(self.tables) > self.max_open:
+            _, old_table = self.tables.popitem(last=False)
+            if old_table is not None:
+                old_table.close()
+        return table
+
+    def probe_pieces(self, pieces, white_to_move):
+        """
+        (WIN, DRAW or LOSS, plies to mate) for the player to move of the position given as (piece, square) pairs, or
+        None if there is no table for it. A table also gives the positions with the colors swapped.
+        """
+        name = material_name([piece for piece, _ in pieces])
+        if name == "KvK":
+            return DRAW, 0
+        table = self.get_table(name)
+        if table is None:
+            table = self.get_table(flip_name(name))
+            if table is None:
+                return None
+            # the same position seen from the other side: colors swapped and board upside down
+            pieces = [(OPPONENT[piece[0]] + piece[1], square ^ 56) for piece, square in pieces]
+            white_to_move = not white_to_move
+        return table.probe_pieces(pieces, white_to_move)
+
+    def probe(self, gs):
+        """
+        (WIN, DRAW or LOSS, plies to mate) of a GameState for the player to move, or None if it is not in a table.
+        """
+        occupied = gs.occupancy["w"] | gs.occupancy["b"]
+        if bin(occupied).count("1") > self.max_pieces or gs.castle_rights:
+            return None
+        us = gs.color
+        if (gs.enpassant_sq is not None
+                and ChessEngine.PAWN_ATTACKS[OPPONENT[us]][gs.enpassant_sq] & gs.bitboards[us + "P"]):
+            return None
+        pieces = [(piece, square) for piece, bb in gs.bitboards.items() for square in ChessEngine.iter_squares(bb)]
+        return self.probe_pieces(pieces, gs.whiteToMove)
+
+
+def table_path(name, directory=TABLEBASE_DIR):
+    return os.path.join(directory, name + EXTENSION)
+
+
+def dependencies(name):
+    """
+    Names of the tables reachable from a table by a capture or a promotion.
+    """
+    pieces = table_pieces(name)
+    names = set()
+    for slot, piece in enumerate(pieces):
+        others = pieces[:slot] + pieces[slot + 1:]
+        if piece[1] != "K":
+            names.add(material_name(others))
+        if piece[1] == "P":
+            for promotion in PROMOTION_PIECES:
+                names.add(material_name(others + [piece[0] + promotion]))
+    names.discard("KvK")
+    return sorted(names)
+
+
+def _unmove_squares(piece, square, occupied):
+    """
+    Squares a piece on a square could have come from with a move which was not a capture (the reverse moves).
+    """
+    kind = piece[1]
+    if kind in "KN":
+        targets = ChessEngine.KING_TARGETS if kind == "K" else ChessEngine.KNIGHT_TARGETS
+        return [start for start in targets[square] if not occupied >> start & 1]
+    if kind == "P":
+        row = square // 8
+        step = 8 if piece[0] == "w" else -8  # white pawns go up the board, so they come from below
+        if not (row <= 5 if piece[0] == "w" else row >= 2) or occupied >> (square + step) & 1:
+            return []
+        starts = [square + step]
+        if row == (4 if piece[0] == "w" else 3) and not occupied >> (square + 2 * step) & 1:
+            starts.append(square + 2 * step)
+        return starts
+    ray_lists = {"R": ChessEngine.ROOK_RAY_LISTS, "B": ChessEngine.BISHOP_RAY_LISTS, "Q": ChessEngine.QUEEN_RAY_LISTS}
+    starts = []
+    for ray in ray_lists[kind][square]:
+        for start in ray:
+            if occupied >> start & 1:
+                break
+            starts.append(start)
+    return starts
+
+
+def build_table(name, directory=TABLEBASE_DIR, log=print):
+    """
+    Compute a table by retrograde analysis and write it in the directory (the tables it depends on first, if they are
+    not there). The legal moves of each position are counted with GameState.getValidMoves, the captures and
+    promotions are looked up in the smaller tables. Then, from the mates, the results go back move by move (with the
+    reverse moves) in the order of the distance to mate: a position with a move to a lost position is won, a position
+    whose moves all go to won positions is lost. What is never reached is a draw.
+    """
+    pieces = table_pieces(name)
+    if "wP" in pieces and "bP" in pieces:
+        raise ValueError("tables with pawns of both colors are not supported (en passant)")
+    os.makedirs(directory, exist_ok=True)
+    for dependency in dependencies(name):
+        if not (os.path.exists(table_path(dependency, directory))
+                or os.path.exists(table_path(flip_name(dependency), directory))):
+            build_table(dependency, directory, log)
+    start_time = time.perf_counter()
+    tablebases = Tablebases(directory)
+    count = len(pieces)
+    weights = [64 ** (count - 1 - slot) for slot in range(count)]
+    half = 64 ** count
+    legal = bytearray(2 * half)
+    resolved = bytearray(2 * half)
+    values = bytearray(2 * half)
+    counts = bytearray(2 * half)  # moves which stay in the table and don't go to a position won by the opponent yet
+    flags = bytearray(2 * half)
+    loss_exits = bytearray(2 * half)  # plies to be mated after the longest losing capture or promotion
+    buckets = collections.defaultdict(list)  # plies -> [(index, WIN or LOSS)] to set when the search gets there
+
+    # 1. every legal position: its moves, and the value of its captures and promotions
+    gs = ChessEngine.GameState()
+    pawn_slots = [slot for slot, piece in enumerate(pieces) if piece[1] == "P"]
+    for squares in itertools.product(range(64), repeat=count):
+        if len(set(squares)) < count or any(squares[slot] < 8 or squares[slot] >= 56 for slot in pawn_slots):
+            continue
+        position = sum(square * weight for square, weight in zip(squares, weights))
+        placed = list(zip(pieces, squares))
+        for side, white_to_move in ((0, True), (1, False)):
+            gs.set_pieces(placed, white_to_move)
+            us = gs.color
+            if gs.is_square_attacked(gs.king_sq[OPPONENT[us]], us):
+                continue  # the player who has just moved can't be in check
+            index = side * half + position
+            legal[index] = 1
+            valid_moves = gs.getValidMoves()
+            if not valid_moves:
+                if gs.checkmate:
+                    buckets[0].append((index, LOSS))
+                else:
+                    resolved[index] = 1  # stalemate
+                continue
+            in_table = 0
+            win_exit = None
+            for move in valid_moves:
+                move_id = move.moveID
+                start = move_id & 63
+                end = move_id >> 6 & 63
+                promotion = move_id >> 12 & ChessEngine.FLAG_PROMOTION
+                if gs.mailbox[end] == EMPTY and not promotion:
+                    in_table += 1
+                    continue
+                child = []
+                for piece, square in placed:
+                    if square == start:
+                        child.append((us + move.promotion if promotion else piece, end))
+                    elif square != end:
+                        child.append((piece, square))
+                child_wdl, child_plies = tablebases.probe_pieces(child, not white_to_move)
+                if child_wdl == LOSS:
+                    win_exit = child_plies + 1 if win_exit is None else min(win_exit, child_plies + 1)
+                elif child_wdl == DRAW:
+                    flags[index] |= DRAW_EXIT
+                else:
+                    loss_exits[index] = max(loss_exits[index], child_plies + 1)
+            counts[index] = in_table
+            if win_exit is not None:
+                flags[index] |= WIN_EXIT
+                buckets[win_exit].append((index, WIN))
+            elif not in_table and not flags[index]:
+                buckets[loss_exits[index]].append((index, LOSS))  # all the moves are losing captures
+
+    # 2. back from the mates, by distance to mate
+    while buckets:
+        plies = min(buckets)
+        for index, wdl in buckets.pop(plies):
+            if resolved[index]:
+                continue
+            resolved[index] = 1
+            values[index] = encode(wdl, plies)
+            side, position = divmod(index, half)
+            squares = [position // weight % 64 for weight in weights]
+            occupied = 0
+            for square in squares:
+                occupied |= 1 << square
+            mover = "b" if side == 0 else "w"  # the player who made the last move
+            previous_side = (1 - side) * half
+            for slot, piece in enumerate(pieces):
+                if piece[0] != mover:
+                    continue
+                square = squares[slot]
+                for start in _unmove_squares(piece, square, occupied):
+                    previous = previous_side + position + (start - square) * weights[slot]
+                    if not legal[previous] or resolved[previous]:
+                        continue
+                    if wdl == LOSS:
+                        buckets[plies + 1].append((previous, WIN))
+                    else:
+                        counts[previous] -= 1
+                        if not counts[previous] and not flags[previous]:
+                            buckets[max(plies + 1, loss_exits[previous])].append((previous, LOSS))
+
+    with open(table_path(name, directory), "wb") as table_file:
+        table_file.write(MAGIC + name.ljust(HEADER_SIZE - len(MAGIC)).encode("ascii"))
+        table_file.write(values)
+    tablebases.close()
+    wins = sum(1 for value in values if 0 < value < 128)
+    losses = sum(1 for index, value in enumerate(values) if value >= 128)
+    log(f"{name}: {sum(legal)} positions, {wins} wins, {losses} losses, longest mate {max(values) % 128} plies "
+        f"({time.perf_counter() - start_time:.1f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build endgame tablebases, or look a position up in them.")
+    ChessStats.add_arguments(parser)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="build tables (ex: KQvK KRvK KPvK)")
+    build_parser.add_argument("names", nargs="+")
+    build_parser.add_argument("--dir", default=TABLEBASE_DIR)
+    probe_parser = subparsers.add_parser("probe", help="print the result of a position")
+    probe_parser.add_argument("--fen", required=True)
+    probe_parser.add_argument("--dir", default=TABLEBASE_DIR)
+    args = parser.parse_args()
+
+    with ChessStats.session(args):
+        if args.command == "build":
+            for name in args.names:
+                build_table(name, args.dir)
+        else:
+            gs = ChessEngine.GameState.from_fen(args.fen)
+            result = Tablebases(args.dir).probe(gs)
+            if result is None:
+                print("not in the tablebases")
+            else:
+                wdl, plies = result
+                print({WIN: f"win, mate in {plies} plies", DRAW: "draw", LOSS: f"loss, mated in {plies} plies"}[wdl])
+
+
+if __name__ == "__main__":
+    main()